@@ -0,0 +1,85 @@
+import random
+
+from scripts.inoutcalibration import TripInTripOutMatrix
+
+"""Seeded generators of synthetic inputs for the benchmarks."""
+
+
+def generate_tripintripout_matrix(dim, seed=0, density=1.0):
+    """
+    Creates a random trip-in-trip-out-matrix and random section volumes to calibrate it to.
+
+    Args:
+        dim (int): number of stops.
+        seed (int): seed of the random numbers.
+        density (float): probability of an entry (i, j), i < j, to be nonzero.
+
+    Returns:
+        (tuple) matrix and list of dim - 1 section volumes.
+    """
+    rnd = random.Random(seed)
+    tripintripout_matrix = TripInTripOutMatrix(dim)
+    for i in range(1, dim + 1):
+        for j in range(i + 1, dim + 1):
+            if rnd.random() < density:
+                tripintripout_matrix[i, j] = rnd.uniform(0.0, 10.0)
+    calibration_volumes = [rnd.uniform(10.0, 100.0) for _ in range(dim - 1)]
+    return tripintripout_matrix, calibration_volumes
+
+
+def generate_timetable(nb_routes, nb_stops, route_length=20, trunk_share=0.5, seed=0):
+    """
+    Creates routes, which partly run on common trunk corridors and partly on own branches.
+
+    Args:
+        nb_routes (int): number of routes (time profiles).
+        nb_stops (int): number of stops in the network, of which the first half lie on trunk corridors.
+        route_length (int): number of stops per route.
+        trunk_share (float): share of the stops of a route on a trunk corridor.
+        seed (int): seed of the random numbers.
+
+    Returns:
+        (dict) stops per route id.
+    """
+    rnd = random.Random(seed)
+    nb_trunk_stops = max(nb_stops // 2, route_length)
+    nb_trunk_route_stops = int(route_length * trunk_share)
+    route_per_id = {}
+    for route_id in range(nb_routes):
+        trunk_start = rnd.randint(0, nb_trunk_stops - nb_trunk_route_stops)
+        trunk = list(range(trunk_start, trunk_start + nb_trunk_route_stops))
+        branch = []
+        while len(branch) < route_length - nb_trunk_route_stops:
+            stop = rnd.randrange(nb_trunk_stops, max(nb_stops, nb_trunk_stops + route_length))
+            if stop not in branch:
+                branch.append(stop)
+        nb_stops_before_trunk = rnd.randint(0, len(branch))
+        route_per_id[route_id] = tuple(branch[:nb_stops_before_trunk] + trunk + branch[nb_stops_before_trunk:])
+    return route_per_id
+
+
+def generate_stop_network(nb_stops, nb_edges, seed=0):
+    """
+    Creates a random directed acyclic graph, consisting of a path through all stops and additional random edges.
+
+    Args:
+        nb_stops (int): number of stops (vertices).
+        nb_edges (int): number of edges, at least nb_stops - 1.
+        seed (int): seed of the random numbers.
+
+    Returns:
+        (dict) set of successors per stop.
+    """
+    rnd = random.Random(seed)
+    stops = list(range(nb_stops))
+    rnd.shuffle(stops)
+    successors_per_stop = {stop: set() for stop in stops}
+    for ind in range(nb_stops - 1):
+        successors_per_stop[stops[ind]].add(stops[ind + 1])
+    nb_edges_so_far = nb_stops - 1
+    while nb_edges_so_far < min(nb_edges, nb_stops * (nb_stops - 1) // 2):
+        ind_1, ind_2 = sorted([rnd.randrange(nb_stops), rnd.randrange(nb_stops)])
+        if ind_1 != ind_2 and stops[ind_2] not in successors_per_stop[stops[ind_1]]:
+            successors_per_stop[stops[ind_1]].add(stops[ind_2])
+            nb_edges_so_far += 1
+    return successors_per_stop
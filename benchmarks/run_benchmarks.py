@@ -0,0 +1,138 @@
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+from benchmarks.generators import generate_stop_network, generate_timetable, generate_tripintripout_matrix
+from scripts.inoutcalibration import calibrate_packed
+from scripts.route_aggregation import aggregate_routes
+from scripts.route_linearization import linearize_stops_in_multiple_routes
+
+"""
+Benchmarks of the entry points of the scripts on synthetic inputs of increasing size.
+
+Usage: python -m benchmarks.run_benchmarks [--output results.json] [--baseline benchmarks/baseline.json]
+"""
+
+SIZES = {
+    "calibrate": [25, 50, 100, 200],
+    "calibrate_packed": [25, 50, 100, 200],
+    "aggregate_routes": [1000, 2000, 4000, 8000],
+    "linearize_stops_in_multiple_routes": [5000, 10000, 20000, 40000],
+}
+
+
+def setup_calibrate(size):
+    tripintripout_matrix, calibration_volumes = generate_tripintripout_matrix(size, seed=size)
+    return lambda: tripintripout_matrix.calibrate(calibration_volumes)
+
+
+def setup_calibrate_packed(size):
+    tripintripout_matrix, calibration_volumes = generate_tripintripout_matrix(size, seed=size)
+    return lambda: calibrate_packed(tripintripout_matrix._values, calibration_volumes)
+
+
+def setup_aggregate_routes(size):
+    route_per_id = generate_timetable(size, 4 * size, seed=size)
+    return lambda: aggregate_routes(route_per_id, nb_subsequent_stops=3)
+
+
+def setup_linearize_stops_in_multiple_routes(size):
+    successors_per_stop = generate_stop_network(size, 3 * size, seed=size)
+    return lambda: linearize_stops_in_multiple_routes(successors_per_stop)
+
+
+SETUP_PER_BENCHMARK = {
+    "calibrate": setup_calibrate,
+    "calibrate_packed": setup_calibrate_packed,
+    "aggregate_routes": setup_aggregate_routes,
+    "linearize_stops_in_multiple_routes": setup_linearize_stops_in_multiple_routes,
+}
+
+
+def run_benchmark(benchmark, size):
+    """Runs a benchmark in a new process, such that the peak memory is measured separately per benchmark."""
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_benchmark_in_process, args=(benchmark, size, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def _run_benchmark_in_process(benchmark, size, results):
+    sys.stdout = open(os.devnull, "w")
+    function = SETUP_PER_BENCHMARK[benchmark](size)
+    peak_rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    function()
+    seconds = time.time() - start
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put({"benchmark": benchmark, "size": size, "seconds": seconds, "peak_rss_kb": peak_rss,
+                 "input_peak_rss_kb": peak_rss_before})
+
+
+def add_growth_exponents(results):
+    """Adds the exponent k of the running time ~ size^k between each size and the next smaller one."""
+    previous_result_per_benchmark = {}
+    for result in results:
+        previous_result = previous_result_per_benchmark.get(result["benchmark"])
+        if previous_result is not None and previous_result["seconds"] > 0 and result["seconds"] > 0 and \
+                result["size"] != previous_result["size"]:
+            result["growth_exponent"] = math.log(result["seconds"] / previous_result["seconds"]) / math.log(
+                float(result["size"]) / previous_result["size"])
+        previous_result_per_benchmark[result["benchmark"]] = result
+    return results
+
+
+def compare_with_baseline(results, baseline_results, tolerance):
+    """Returns the messages for the results which are slower than the baseline by more than the factor tolerance."""
+    baseline_result_per_key = {(r["benchmark"], r["size"]): r for r in baseline_results}
+    regressions = []
+    for result in results:
+        baseline_result = baseline_result_per_key.get((result["benchmark"], result["size"]))
+        if baseline_result is None:
+            continue
+        ratio = result["seconds"] / baseline_result["seconds"] if baseline_result["seconds"] > 0 else 1.0
+        result["ratio_to_baseline"] = ratio
+        if ratio > tolerance:
+            regressions.append("{} with size {}: {:.4f}s, baseline {:.4f}s".format(
+                result["benchmark"], result["size"], result["seconds"], baseline_result["seconds"]))
+    return regressions
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Benchmarks of the scripts on synthetic inputs.")
+    parser.add_argument("--benchmarks", nargs="*", default=sorted(SIZES), choices=sorted(SIZES))
+    parser.add_argument("--scale", type=float, default=1.0, help="factor applied to all sizes")
+    parser.add_argument("--output", help="path of the JSON results, printed if not given")
+    parser.add_argument("--baseline", help="path of JSON results to compare with")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="allowed slowdown factor to the baseline")
+    options = parser.parse_args(args)
+
+    results = []
+    for benchmark in options.benchmarks:
+        for size in SIZES[benchmark]:
+            results.append(run_benchmark(benchmark, max(2, int(size * options.scale))))
+    add_growth_exponents(results)
+    regressions = []
+    if options.baseline:
+        with open(options.baseline) as f:
+            regressions = compare_with_baseline(results, json.load(f), options.tolerance)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    for regression in regressions:
+        sys.stderr.write("regression: {}\n".format(regression))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
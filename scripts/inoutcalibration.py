@@ -1,110 +1,832 @@
+from array import array
+from collections import OrderedDict
 from collections import defaultdict
+from collections import deque
 
+import argparse
+import csv
+import ctypes
+import functools
 import math
+import mmap
+import multiprocessing
+import operator
+import os
+import struct
+import sys
+import threading
+import time
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+from scripts import instrumentation
 
 """A script for calibrating trip-in-trip-out-matrices to section volumes by distance minimization."""
 
+# entries with absolute value up to the drop tolerance are treated as zero, e.g. rounding noise after projections
+DROP_TOLERANCE = 1e-12
+
+# binary file format: magic number, version and dimension n, followed by the packed values as little-endian doubles
+MATRIX_FILE_MAGIC = b"TITO"
+MATRIX_FILE_VERSION = 1
+MATRIX_FILE_HEADER = struct.Struct("<4sIQ")
+MATRIX_FILE_VALUE_SIZE = struct.calcsize("<d")
+
+# number of seed matrices kept loaded while reading calibration jobs
+SEED_CACHE_SIZE = 8
+
+
+class TripInTripOutMatrix(object):
+    """
+    Upper triangular matrix of trips from stop i to stop j (1 <= i <= j <= n).
+
+    The entries are stored row by row in a packed array of length n * (n + 1) / 2, such that the arithmetic
+    operations run over flat arrays instead of dictionaries. As for the former dict, the entries != 0 count as stored
+    and the dict API (iteration, len, in, get, keys, values and items) refers to them. Only get_nonzero_entries and
+    prune treat the entries up to a tolerance, by default DROP_TOLERANCE, as zero.
+    """
 
-class TripInTripOutMatrix(defaultdict):
     def __init__(self, dim):
         if not dim > 0:
             raise ValueError("dimension must be > 0, but is {}".format(dim))
-        self.default_factory = lambda: 0.0
         self.n = dim
+        self._values = array("d", [0.0]) * get_packed_size(dim)
+        self._section_volumes = None
 
-    def __setitem__(self, key, value):
+    @classmethod
+    def _from_values(cls, dim, values):
+        """Wraps an array of packed values without copying and without validating the entries."""
+        matrix = cls.__new__(cls)
+        matrix.n = dim
+        matrix._values = values
+        matrix._section_volumes = None
+        return matrix
+
+    def _get_index(self, key):
         if not isinstance(key, tuple) or len(key) != 2:
             raise KeyError("key must be a pair: {}".format(key))
         if not 1 <= key[0] <= self.n:
             raise KeyError("first index of {} must be between 1 and {}".format(key, self.n))
         if not key[0] <= key[1] <= self.n:
             raise KeyError("second index of {} must be between first index + 1 and {}".format(key, self.n))
+        return get_packed_index(key[0], key[1], self.n)
+
+    def _get_value(self, key):
+        """Entry of a valid key."""
+        return self._values[get_packed_index(key[0], key[1], self.n)]
+
+    def __getitem__(self, key):
+        return self._values[self._get_index(key)]
+
+    def __setitem__(self, key, value):
+        index = self._get_index(key)
         if not isinstance(value, (float, int)):
             raise ValueError("value must be float or int: {}".format(value))
-        super(TripInTripOutMatrix, self).__setitem__(key, value)
+        self._update_section_volumes(key, value - self._values[index])
+        self._values[index] = value
+
+    def _update_section_volumes(self, key, delta):
+        if self._section_volumes is not None:
+            # the entry (i, j) contributes to the sections i, ..., j - 1
+            for k in range(key[0] - 1, key[1] - 1):
+                self._section_volumes[k] += delta
+
+    def _add_scaled_section_volumes(self, alpha, other):
+        if self._section_volumes is not None:
+            if other._section_volumes is None:
+                self._section_volumes = None
+            else:
+                for k, volume in enumerate(other._section_volumes):
+                    self._section_volumes[k] += alpha * volume
+
+    def _scale_section_volumes(self, scalar):
+        if self._section_volumes is not None:
+            for k in range(len(self._section_volumes)):
+                self._section_volumes[k] *= scalar
+
+    def __eq__(self, other):
+        if not isinstance(other, TripInTripOutMatrix):
+            return NotImplemented
+        values, other_values = self._values, other._values
+        if not (isinstance(values, array) and isinstance(other_values, array)):
+            # e.g. the ctypes array of a memory-mapped file, which does not compare by value
+            values, other_values = list(values), list(other_values)
+        return self.n == other.n and values == other_values
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __iter__(self):
+        return (key for key, value in zip(iter_packed_keys(self.n), self._values) if value != 0.0)
+
+    def __len__(self):
+        return sum(1 for value in self._values if value != 0.0)
+
+    def __contains__(self, key):
+        try:
+            index = self._get_index(key)
+        except KeyError:
+            return False
+        return self._values[index] != 0.0
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def values(self):
+        return [value for value in self._values if value != 0.0]
 
     def __add__(self, other):
         check_compatibility_of_tripintripout_matrices(self, other)
-        new_matrix = TripInTripOutMatrix(self.n)
-        keys = self.get_nonzero_entries().union(other.get_nonzero_entries())
-        for key in keys:
-            new_matrix[key] = self[key] + other[key]
-        return new_matrix
+        return TripInTripOutMatrix._from_values(self.n, array("d", map(operator.add, self._values, other._values)))
+
+    def __sub__(self, other):
+        check_compatibility_of_tripintripout_matrices(self, other)
+        return TripInTripOutMatrix._from_values(self.n, array("d", map(operator.sub, self._values, other._values)))
 
     def __mul__(self, other):
         check_compatibility_of_tripintripout_matrices(self, other)
-        new_matrix = TripInTripOutMatrix(self.n)
-        keys = self.get_nonzero_entries().intersection(other.get_nonzero_entries())
-        for key in keys:
-            new_matrix[key] = self[key] * other[key]
-        return new_matrix
+        if isinstance(other, SparseTripInTripOutMatrix):
+            return other * self
+        return TripInTripOutMatrix._from_values(self.n, array("d", map(operator.mul, self._values, other._values)))
+
+    def __iadd__(self, other):
+        return self.axpy(1.0, other)
+
+    def __isub__(self, other):
+        return self.axpy(-1.0, other)
+
+    def __imul__(self, other):
+        """Multiplies in place, elementwise by a matrix or by a scalar."""
+        values = self._values
+        if isinstance(other, TripInTripOutMatrix):
+            check_compatibility_of_tripintripout_matrices(self, other)
+            values[:] = array("d", map(operator.mul, values, other._values))
+            self._section_volumes = None
+        else:
+            values[:] = array("d", [other * value for value in values])
+            self._scale_section_volumes(other)
+        return self
+
+    def axpy(self, alpha, other):
+        """Adds alpha * other in place and returns this matrix."""
+        check_compatibility_of_tripintripout_matrices(self, other)
+        values = self._values
+        if isinstance(other, SparseTripInTripOutMatrix):
+            for (i, j), value in other._entries.items():
+                values[get_packed_index(i, j, self.n)] += alpha * value
+        else:
+            # the new values are computed in one pass and written back, so the values object stays the same
+            values[:] = array("d", map(operator.add, values, [alpha * value for value in other._values]))
+        self._add_scaled_section_volumes(alpha, other)
+        return self
+
+    def copy(self):
+        matrix = TripInTripOutMatrix._from_values(self.n, array("d", self._values))
+        matrix._section_volumes = None if self._section_volumes is None else array("d", self._section_volumes)
+        return matrix
 
     def __repr__(self):
-        res = ""
+        values = self._values
+        rows = []
         for i in range(1, self.n + 1):
-            res += " ".join(
-                [" " * 10 for j in range(1, i)] + ["{:10.4f}".format(self[i, j]) for j in range(i, self.n + 1)]) + "\n"
-        return res
+            row_start = get_packed_index(i, i, self.n)
+            rows.append(" ".join([" " * 10] * (i - 1) + ["{:10.4f}".format(value) for value in
+                                                         values[row_start:row_start + self.n - i + 1]]) + "\n")
+        return "".join(rows)
+
+    def write_csv(self, f, delimiter=";"):
+        """Writes the nonzero entries as rows i, j, value to an open file, row by row."""
+        f.write(delimiter.join(["i", "j", "value"]) + "\n")
+        f.writelines("{1}{0}{2}{0}{3!r}\n".format(delimiter, i, j, value) for (i, j), value in self.items())
+
+    def save(self, path):
+        """Saves the matrix in the binary format, which can be loaded with load."""
+        save_packed_values(path, self._values, self.n)
+
+    @classmethod
+    def load(cls, path, use_mmap=False):
+        """Loads a matrix saved by save. With use_mmap, the values are memory-mapped instead of read."""
+        dim, values = load_packed_values(path, use_mmap=use_mmap)
+        return TripInTripOutMatrix._from_values(dim, values)
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return [(key, value) for key, value in zip(iter_packed_keys(self.n), self._values) if value != 0.0]
+
+    def prune(self, tolerance=None):
+        """Sets the entries with absolute value up to the tolerance (by default DROP_TOLERANCE) to 0."""
+        tolerance = DROP_TOLERANCE if tolerance is None else tolerance
+        values = self._values
+        for ind, value in enumerate(values):
+            if value != 0.0 and abs(value) <= tolerance:
+                values[ind] = 0.0
+                self._section_volumes = None
+        return self
 
     def mult_by_scalar(self, scalar):
-        new_matrix = TripInTripOutMatrix(self.n)
-        for key in self.get_nonzero_entries():
-            new_matrix[key] = scalar * self[key]
-        return new_matrix
+        return TripInTripOutMatrix._from_values(self.n, array("d", [scalar * value for value in self._values]))
+
+    def dot(self, other):
+        """Scalar product, without creating the elementwise product."""
+        check_compatibility_of_tripintripout_matrices(self, other)
+        if isinstance(other, SparseTripInTripOutMatrix):
+            return other.dot(self)
+        return sum(map(operator.mul, self._values, other._values))
 
     def scalar_product(self, other):
-        new_matrix = self * other
-        sum = 0.0
-        for key in new_matrix.get_nonzero_entries():
-            sum += new_matrix[key]
-        return sum
+        return self.dot(other)
 
     def norm(self):
         return math.sqrt(self.scalar_product(self))
 
-    def get_nonzero_entries(self):
-        return {key for key in self.keys() if self[key] != 0.0}
+    def get_nonzero_entries(self, tolerance=None):
+        """Keys of the entries with absolute value above the tolerance (by default DROP_TOLERANCE)."""
+        tolerance = DROP_TOLERANCE if tolerance is None else tolerance
+        return {key for key, value in self.items() if abs(value) > tolerance}
 
     def get_section_volume(self, k):
-        if not 1 <= self.n - 1:
+        if not 1 <= k <= self.n - 1:
             raise ValueError("index of abschnitt is {}, should be between 1 and {} - 1".format(k, self.n))
-        sum = 0.0
-        for i in range(1, k + 1):
-            for j in range(k + 1, self.n + 1):
-                sum += self[i, j]
-        return sum
+        return self._get_cached_section_volumes()[k - 1]
 
     def get_section_volumes(self):
-        return [self.get_section_volume(k) for k in range(1, self.n)]
+        return list(self._get_cached_section_volumes())
+
+    def _get_cached_section_volumes(self):
+        """Section volumes, computed once and then kept up to date by __setitem__."""
+        if self._section_volumes is None:
+            self._section_volumes = self._compute_section_volumes()
+        return self._section_volumes
+
+    def _compute_section_volumes(self):
+        return get_section_volumes_of_packed_values(self._values, self.n)
 
     def calibrate(self, calibration_volumes):
-        b = get_trivial_solution(self.n, calibration_volumes)
-        orthonormal_basis_of_normal_space = get_orthonormal_basis_of_normal_space(self.n)
-        b_1, b_2 = get_components(b, orthonormal_basis_of_normal_space)
-        f_1, f_2 = get_components(self, orthonormal_basis_of_normal_space)
-        s = b_2.scalar_product(f_2) / f_2.norm() ** 2
-        return b_2 + f_1.mult_by_scalar(s)
+        return calibrate_batch([self], [calibration_volumes])[0]
+
+
+class SparseTripInTripOutMatrix(TripInTripOutMatrix):
+    """
+    Trip-in-trip-out-matrix, which only stores its nonzero entries in a dictionary.
+
+    Reading an entry does not store anything and setting an entry to 0 removes it, so the operations with other
+    sparse matrices run in the number of nonzero entries. Results of the arithmetic operations with absolute value up
+    to DROP_TOLERANCE are dropped. Combined with a dense matrix, the result of an addition or subtraction is dense.
+    """
+
+    def __init__(self, dim):
+        if not dim > 0:
+            raise ValueError("dimension must be > 0, but is {}".format(dim))
+        self.n = dim
+        self._entries = {}
+        self._section_volumes = None
+
+    @classmethod
+    def _from_entries(cls, dim, entries):
+        """Wraps a dictionary of nonzero entries without copying and without validating the entries."""
+        matrix = cls.__new__(cls)
+        matrix.n = dim
+        matrix._entries = entries
+        matrix._section_volumes = None
+        return matrix
+
+    @classmethod
+    def from_matrix(cls, tripintripout_matrix):
+        return cls._from_entries(tripintripout_matrix.n, dict(tripintripout_matrix.items()))
+
+    @property
+    def _values(self):
+        """Packed values as in TripInTripOutMatrix, used when combined with a dense matrix."""
+        values = array("d", [0.0]) * get_packed_size(self.n)
+        for (i, j), value in self._entries.items():
+            values[get_packed_index(i, j, self.n)] = value
+        return values
+
+    def _get_value(self, key):
+        return self._entries.get(key, 0.0)
+
+    def __getitem__(self, key):
+        self._get_index(key)
+        return self._entries.get(key, 0.0)
+
+    def __setitem__(self, key, value):
+        self._get_index(key)
+        if not isinstance(value, (float, int)):
+            raise ValueError("value must be float or int: {}".format(value))
+        self._update_section_volumes(key, value - self._entries.get(key, 0.0))
+        if value != 0.0:
+            self._entries[key] = value
+        else:
+            self._entries.pop(key, None)
+
+    def __iter__(self):
+        return iter(sorted(self._entries))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        try:
+            self._get_index(key)
+        except KeyError:
+            return False
+        return key in self._entries
+
+    def values(self):
+        return [value for _, value in sorted(self._entries.items())]
+
+    def __eq__(self, other):
+        if isinstance(other, SparseTripInTripOutMatrix):
+            return self.n == other.n and self._entries == other._entries
+        return super(SparseTripInTripOutMatrix, self).__eq__(other)
+
+    __hash__ = None
+
+    def __add__(self, other):
+        return self._add_scaled(other, 1.0)
+
+    def __sub__(self, other):
+        return self._add_scaled(other, -1.0)
+
+    def _add_scaled(self, other, factor):
+        check_compatibility_of_tripintripout_matrices(self, other)
+        if not isinstance(other, SparseTripInTripOutMatrix):
+            return TripInTripOutMatrix._from_values(self.n, array("d", map(
+                operator.add, self._values, [factor * value for value in other._values])))
+        entries = dict(self._entries)
+        for key, value in other._entries.items():
+            new_value = entries.get(key, 0.0) + factor * value
+            if abs(new_value) > DROP_TOLERANCE:
+                entries[key] = new_value
+            else:
+                entries.pop(key, None)
+        return SparseTripInTripOutMatrix._from_entries(self.n, entries)
+
+    def __mul__(self, other):
+        check_compatibility_of_tripintripout_matrices(self, other)
+        entries = {}
+        for key, value in self._entries.items():
+            new_value = value * other._get_value(key)
+            if abs(new_value) > DROP_TOLERANCE:
+                entries[key] = new_value
+        return SparseTripInTripOutMatrix._from_entries(self.n, entries)
+
+    def __imul__(self, other):
+        entries = self._entries
+        if isinstance(other, TripInTripOutMatrix):
+            check_compatibility_of_tripintripout_matrices(self, other)
+            for key in list(entries):
+                new_value = entries[key] * other._get_value(key)
+                if abs(new_value) > DROP_TOLERANCE:
+                    entries[key] = new_value
+                else:
+                    del entries[key]
+            self._section_volumes = None
+        elif other == 0.0:
+            entries.clear()
+            self._scale_section_volumes(other)
+        else:
+            for key in entries:
+                entries[key] *= other
+            self._scale_section_volumes(other)
+        return self
+
+    def axpy(self, alpha, other):
+        check_compatibility_of_tripintripout_matrices(self, other)
+        entries = self._entries
+        for key, value in other.items():
+            new_value = entries.get(key, 0.0) + alpha * value
+            if abs(new_value) > DROP_TOLERANCE:
+                entries[key] = new_value
+            else:
+                entries.pop(key, None)
+        self._add_scaled_section_volumes(alpha, other)
+        return self
+
+    def copy(self):
+        matrix = SparseTripInTripOutMatrix._from_entries(self.n, dict(self._entries))
+        matrix._section_volumes = None if self._section_volumes is None else array("d", self._section_volumes)
+        return matrix
+
+    def items(self):
+        return sorted(self._entries.items())
+
+    def prune(self, tolerance=None):
+        tolerance = DROP_TOLERANCE if tolerance is None else tolerance
+        for key, value in list(self._entries.items()):
+            if abs(value) <= tolerance:
+                del self._entries[key]
+                self._section_volumes = None
+        return self
+
+    def mult_by_scalar(self, scalar):
+        if scalar == 0.0:
+            return SparseTripInTripOutMatrix(self.n)
+        return SparseTripInTripOutMatrix._from_entries(
+            self.n, {key: scalar * value for key, value in self._entries.items()})
+
+    def dot(self, other):
+        check_compatibility_of_tripintripout_matrices(self, other)
+        if isinstance(other, SparseTripInTripOutMatrix) and len(other._entries) < len(self._entries):
+            return other.dot(self)
+        return sum(value * other._get_value(key) for key, value in self._entries.items())
+
+    def _compute_section_volumes(self):
+        # the entry (i, j) is added to the sections i, ..., j - 1 by a difference array
+        changes = [0.0] * (self.n + 1)
+        for (i, j), value in self._entries.items():
+            changes[i] += value
+            changes[j] -= value
+        section_volumes = array("d")
+        volume = 0.0
+        for k in range(1, self.n):
+            volume += changes[k]
+            section_volumes.append(volume)
+        return section_volumes
+
+
+class Calibrator(object):
+    """
+    Calibrates a seed matrix to section volumes which change over time, e.g. by counting stations.
+
+    The decomposition f = f_1 + f_2 of the seed matrix into the parts orthogonal to and in the normal space is
+    computed once. The calibrated matrix b_2 + s * f_1 depends on the volumes b only by the coefficients c of b_2 and
+    by s = <c, v_f> / |f_2|^2, where v_f are the section volumes of f. Changing the volume on section k by delta
+    changes c_(k - 1), c_k and c_(k + 1) by -delta / n, 2 * delta / n and -delta / n and s by delta * f_k / |f_2|^2,
+    where f_k is the k-th coefficient of f_2. The calibrated matrix is updated by these differences in one pass over
+    the packed values, without projecting f again.
+
+    Rounding errors add up over many updates, recalibrate computes the result from scratch.
+    """
+
+    def __init__(self, tripintripout_matrix, calibration_volumes):
+        self.n = tripintripout_matrix.n
+        check_section_volumes(self.n, calibration_volumes)
+        self._seed_section_volumes = tripintripout_matrix.get_section_volumes()
+        self._seed_coefficients = get_normal_space_coefficients(self._seed_section_volumes)
+        self._seed_norm_squared = sum(map(operator.mul, self._seed_coefficients, self._seed_section_volumes))
+        self._f_1_values = array("d", tripintripout_matrix._values)
+        for ind, value in enumerate(get_packed_values_of_normal_space_coefficients(self._seed_coefficients, self.n)):
+            self._f_1_values[ind] -= value
+        self.calibration_volumes = list(calibration_volumes)
+        self.recalibrate()
+
+    def recalibrate(self):
+        """Computes the calibrated matrix for the current volumes from the decomposition of the seed matrix."""
+        coefficients = get_normal_space_coefficients(self.calibration_volumes)
+        self.scale_factor = sum(map(operator.mul, coefficients, self._seed_section_volumes)) / self._seed_norm_squared
+        self._values = get_packed_values_of_normal_space_coefficients(coefficients, self.n)
+        for ind, value in enumerate(self._f_1_values):
+            self._values[ind] += self.scale_factor * value
+
+    def update_volumes(self, volume_per_section):
+        """
+        Sets the volumes of some sections and updates the calibrated matrix in O(n^2), whatever the number of changes.
+
+        Args:
+            volume_per_section (dict): new volume per section k, 1 <= k <= n - 1.
+        """
+        dim = self.n
+        coefficient_deltas = [0.0] * (dim + 1)
+        for k in volume_per_section:
+            if not 1 <= k <= dim - 1:
+                raise ValueError("index of abschnitt is {}, should be between 1 and {} - 1".format(k, dim))
+        for k, volume in volume_per_section.items():
+            delta = volume - self.calibration_volumes[k - 1]
+            self.calibration_volumes[k - 1] = volume
+            coefficient_deltas[k - 1] -= delta / dim
+            coefficient_deltas[k] += 2.0 * delta / dim
+            coefficient_deltas[k + 1] -= delta / dim
+        scale_factor_delta = sum(map(operator.mul, coefficient_deltas[1:dim], self._seed_section_volumes)) / \
+            self._seed_norm_squared
+        self.scale_factor += scale_factor_delta
+
+        # the entry (i, j) of sum_k c_k * beta_k is C_(j - 1) - C_(i - 1) with the prefix sums C of the coefficients
+        prefix_sum_deltas = [0.0]
+        for coefficient_delta in coefficient_deltas[1:dim]:
+            prefix_sum_deltas.append(prefix_sum_deltas[-1] + coefficient_delta)
+        values, f_1_values = self._values, self._f_1_values
+        for i in range(1, dim + 1):
+            row_start = get_packed_index(i, i, dim)
+            row_end = row_start + dim - i + 1
+            prefix_sum_delta_i = prefix_sum_deltas[i - 1]
+            values[row_start:row_end] = array("d", [
+                value + prefix_sum_delta - prefix_sum_delta_i + scale_factor_delta * f_1_value
+                for value, prefix_sum_delta, f_1_value in zip(values[row_start:row_end], prefix_sum_deltas[i - 1:],
+                                                               f_1_values[row_start:row_end])])
+
+    def get_calibrated_matrix(self):
+        """Copy of the calibrated matrix, whose section volumes are the calibration volumes."""
+        calibrated_matrix = TripInTripOutMatrix._from_values(self.n, array("d", self._values))
+        calibrated_matrix._section_volumes = array("d", self.calibration_volumes)
+        return calibrated_matrix
+
+
+def calibrate_batch(tripintripout_matrices, calibration_volumes_list):
+    """
+    Calibrates several matrices of the same dimension to several vectors of section volumes at once.
+
+    Either both lists have the same length and the i-th matrix is calibrated to the i-th section volumes, or one of
+    them has length 1 and is combined with every element of the other. Each matrix is decomposed and each volume
+    vector is projected only once.
+
+    Args:
+        tripintripout_matrices (list): seed matrices of the same dimension n.
+        calibration_volumes_list (list): vectors of n - 1 section volumes.
+
+    Returns:
+        (list) calibrated matrices.
+    """
+    nb_matrices = len(tripintripout_matrices)
+    nb_volumes = len(calibration_volumes_list)
+    if nb_matrices != nb_volumes and 1 not in (nb_matrices, nb_volumes):
+        raise ValueError("cannot combine {} matrices with {} volume vectors".format(nb_matrices, nb_volumes))
+    if nb_matrices == 0 or nb_volumes == 0:
+        return []
+    dim = tripintripout_matrices[0].n
+    for tripintripout_matrix in tripintripout_matrices:
+        check_compatibility_of_tripintripout_matrices(tripintripout_matrices[0], tripintripout_matrix)
+    for calibration_volumes in calibration_volumes_list:
+        check_section_volumes(dim, calibration_volumes)
+
+    # shared work: f = f_1 + f_2 per matrix and b_2 per volume vector
+    section_volumes_list = [f.get_section_volumes() for f in tripintripout_matrices]
+    f_coefficients_list = [get_normal_space_coefficients(v) for v in section_volumes_list]
+    f_1_list = [f - create_from_normal_space_coefficients(c, dim)
+                for f, c in zip(tripintripout_matrices, f_coefficients_list)]
+    f_2_norms_squared = [sum(map(operator.mul, c, v)) for c, v in zip(f_coefficients_list, section_volumes_list)]
+    b_coefficients_list = [get_normal_space_coefficients(v) for v in calibration_volumes_list]
+    b_2_list = [create_from_normal_space_coefficients(c, dim) for c in b_coefficients_list]
+
+    # per pair: the scale factor <b_2, f_2> / <f_2, f_2>, using that <beta_k, f_2> = <beta_k, f> is the k-th section
+    # volume of f, and the calibrated matrix b_2 + s * f_1
+    nb_pairs = max(nb_matrices, nb_volumes)
+    f_indices = range(nb_pairs) if nb_matrices > 1 else [0] * nb_pairs
+    b_indices = range(nb_pairs) if nb_volumes > 1 else [0] * nb_pairs
+    scale_factors = [sum(map(operator.mul, b_coefficients_list[b], section_volumes_list[f])) / f_2_norms_squared[f]
+                     for f, b in zip(f_indices, b_indices)]
+    return [b_2_list[b].copy().axpy(s, f_1_list[f]) for f, b, s in zip(f_indices, b_indices, scale_factors)]
+
+
+def calibrate_packed(values, calibration_volumes, dim=None):
+    """
+    Calibrates a matrix given by its packed upper triangle (see get_packed_index) without creating matrix objects.
+
+    The values are only read, so any sequence of floats supporting len, indexing and slicing can be passed without
+    copying, e.g. an array, a NumPy vector or the memory-mapped values of load_packed_values. With
+    b_2 = sum_k b_k * beta_k and f_2 = sum_k f_k * beta_k, the result b_2 + s * (f - f_2) is computed as
+    s * f + sum_k (b_k - s * f_k) * beta_k.
+
+    Args:
+        values (sequence): packed values of the seed matrix.
+        calibration_volumes (list): n - 1 section volumes.
+        dim (int): dimension n, derived from the number of values if not given.
+
+    Returns:
+        (tuple) packed values of the calibrated matrix and its section volumes, both as array of doubles.
+    """
+    if dim is None:
+        dim = get_dim_of_packed_size(len(values))
+    elif len(values) != get_packed_size(dim):
+        raise ValueError("{} values do not form a matrix of dimension {}".format(len(values), dim))
+    check_section_volumes(dim, calibration_volumes)
+    section_volumes = get_section_volumes_of_packed_values(values, dim)
+    b_coefficients = get_normal_space_coefficients(calibration_volumes)
+    f_coefficients = get_normal_space_coefficients(section_volumes)
+    s = sum(map(operator.mul, b_coefficients, section_volumes)) / sum(
+        map(operator.mul, f_coefficients, section_volumes))
+    calibrated_values = array("d", map(operator.add, get_packed_values_of_normal_space_coefficients(
+        [b - s * f for b, f in zip(b_coefficients, f_coefficients)], dim), [s * value for value in values]))
+    return calibrated_values, get_section_volumes_of_packed_values(calibrated_values, dim)
+
+
+def pack_upper_triangle(rows):
+    """Packs the upper triangle of a square matrix, given as sequence of rows (e.g. a 2-dimensional NumPy array)."""
+    dim = len(rows)
+    values = array("d")
+    for i in range(dim):
+        if len(rows[i]) != dim:
+            raise ValueError("row {} has length {}, but the matrix has {} rows".format(i, len(rows[i]), dim))
+        values.extend(float(value) for value in rows[i][i:])
+    return values
+
+
+def calibrate_parallel(jobs, processes=None, chunk_size=64):
+    """
+    Calibrates matrices of possibly different dimensions on a pool of worker processes.
+
+    The jobs are grouped by dimension and sent in chunks to the workers, which calibrate each chunk with
+    calibrate_batch. The matrices are transferred as packed value arrays.
+
+    Args:
+        jobs (list): pairs (seed matrix, calibration volumes).
+        processes (int): number of worker processes, by default the number of CPUs. With 1, no pool is used.
+        chunk_size (int): maximal number of jobs per task sent to a worker.
+
+    Returns:
+        (list) calibrated matrices in the order of the jobs.
+    """
+    if not chunk_size > 0:
+        raise ValueError("chunk size must be > 0, but is {}".format(chunk_size))
+    job_indices_per_dim = defaultdict(list)
+    for ind, (tripintripout_matrix, _) in enumerate(jobs):
+        job_indices_per_dim[tripintripout_matrix.n] += [ind]
+    chunks = []
+    for dim, job_indices in sorted(job_indices_per_dim.items()):
+        for start in range(0, len(job_indices), chunk_size):
+            chunk_indices = job_indices[start:start + chunk_size]
+            chunks += [(chunk_indices, (dim, [_as_array(jobs[ind][0]._values) for ind in chunk_indices],
+                                        [list(jobs[ind][1]) for ind in chunk_indices]))]
+    tasks = [task for _, task in chunks]
+    if processes == 1:
+        results_per_chunk = [_calibrate_packed_chunk(task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results_per_chunk = pool.map(_calibrate_packed_chunk, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    res = [None] * len(jobs)
+    for (chunk_indices, _), chunk_results in zip(chunks, results_per_chunk):
+        for ind, values in zip(chunk_indices, chunk_results):
+            res[ind] = TripInTripOutMatrix._from_values(jobs[ind][0].n, values)
+    return res
+
+
+def _as_array(values):
+    return values if isinstance(values, array) else array("d", values)
+
+
+def _calibrate_packed_chunk(task):
+    dim, values_list, calibration_volumes_list = task
+    tripintripout_matrices = [TripInTripOutMatrix._from_values(dim, values) for values in values_list]
+    return [m._values for m in calibrate_batch(tripintripout_matrices, calibration_volumes_list)]
 
 
 def get_components(tripintripout_matrix, orthonormal_basis):
     v_2 = TripInTripOutMatrix(tripintripout_matrix.n)
-    for i in range(len(orthonormal_basis)):
-        orthonormal_matrix = orthonormal_basis[i]
-        v_2 += orthonormal_matrix.mult_by_scalar(tripintripout_matrix.scalar_product(orthonormal_matrix))
-    v_1 = tripintripout_matrix + v_2.mult_by_scalar(-1.0)
+    for orthonormal_matrix in orthonormal_basis:
+        v_2.axpy(tripintripout_matrix.dot(orthonormal_matrix), orthonormal_matrix)
+    v_1 = tripintripout_matrix - v_2
     return v_1, v_2
 
 
-def get_trivial_solution(dim, section_volumes):
+def get_normal_space_components(tripintripout_matrix):
+    """Same as get_components with the orthonormal basis of the normal space, but in closed form."""
+    coefficients = get_normal_space_coefficients(tripintripout_matrix.get_section_volumes())
+    v_2 = create_from_normal_space_coefficients(coefficients, tripintripout_matrix.n)
+    return tripintripout_matrix - v_2, v_2
+
+
+def get_normal_space_coefficients(section_volumes):
+    """
+    Coefficients c of the projection sum_k c_k * beta_k onto the normal space.
+
+    The k-th section volume of a matrix f equals <f, beta_k>. The Gram matrix <beta_k, beta_l> = min(k, l) *
+    (n - max(k, l)) is n times the inverse of the tridiagonal matrix with 2 on the diagonal and -1 beside it, hence
+    c_k = (2 * v_k - v_(k - 1) - v_(k + 1)) / n.
+    """
+    dim = len(section_volumes) + 1
+    padded_volumes = [0.0] + list(section_volumes) + [0.0]
+    return [(2.0 * padded_volumes[k] - padded_volumes[k - 1] - padded_volumes[k + 1]) / dim for k in range(1, dim)]
+
+
+def create_from_normal_space_coefficients(coefficients, dim):
+    """Creates the matrix sum_k c_k * beta_k."""
+    return TripInTripOutMatrix._from_values(dim, get_packed_values_of_normal_space_coefficients(coefficients, dim))
+
+
+def get_packed_values_of_normal_space_coefficients(coefficients, dim):
+    """Packed values of the matrix sum_k c_k * beta_k, whose entry (i, j) is c_i + ... + c_(j - 1), by prefix sums."""
+    if len(coefficients) != dim - 1:
+        raise ValueError("coefficients must have length {}, but have length {}".format(dim - 1, len(coefficients)))
+    prefix_sums = [0.0]
+    for coefficient in coefficients:
+        prefix_sums.append(prefix_sums[-1] + coefficient)
+    values = array("d")
+    for i in range(1, dim + 1):
+        prefix_sum_i = prefix_sums[i - 1]
+        values.append(0.0)
+        values.extend([prefix_sums[j - 1] - prefix_sum_i for j in range(i + 1, dim + 1)])
+    return values
+
+
+def check_section_volumes(dim, section_volumes):
     if len(section_volumes) != dim - 1:
         raise ValueError("section volumes must have length {}, but have length {}".format(dim - 1, len(
             section_volumes)))
-    trivial_solution = TripInTripOutMatrix(dim)
+    return True
+
+
+def get_trivial_solution(dim, section_volumes):
+    check_section_volumes(dim, section_volumes)
+    trivial_solution = SparseTripInTripOutMatrix(dim)
     for i in range(0, dim - 1):
         trivial_solution[i + 1, i + 2] = section_volumes[i]
     return trivial_solution
 
 
+def get_packed_size(dim):
+    """Number of entries (i, j) with 1 <= i <= j <= dim."""
+    return dim * (dim + 1) // 2
+
+
+def get_packed_index(i, j, dim):
+    """Position of the entry (i, j) in the row by row packed upper triangle of a matrix of dimension dim."""
+    return (i - 1) * dim - (i - 1) * (i - 2) // 2 + j - i
+
+
+def get_section_volumes_of_packed_values(values, dim):
+    """
+    Volumes on the sections 1, ..., dim - 1 in O(dim^2).
+
+    The volume on section k is the volume on section k - 1 plus the trips boarding at stop k (row k) minus the
+    trips alighting at stop k (column k).
+    """
+    section_volumes = array("d")
+    # the column sums up to the current row, accumulated row by row, the diagonal entries cancel out
+    column_sums = [0.0] * dim
+    volume = 0.0
+    for k in range(1, dim):
+        row_start = get_packed_index(k, k, dim)
+        row = values[row_start:row_start + dim - k + 1]
+        column_sums[k - 1:] = map(operator.add, column_sums[k - 1:], row)
+        volume += sum(row) - column_sums[k - 1]
+        section_volumes.append(volume)
+    return section_volumes
+
+
+def save_packed_values(path, values, dim):
+    """Saves packed values of a matrix in the binary format: header with the dimension and little-endian doubles."""
+    values = _as_array(values)
+    if len(values) != get_packed_size(dim):
+        raise ValueError("{} values do not form a matrix of dimension {}".format(len(values), dim))
+    if sys.byteorder == "big":
+        values = array("d", values)
+        values.byteswap()
+    with open(path, "wb") as f:
+        f.write(MATRIX_FILE_HEADER.pack(MATRIX_FILE_MAGIC, MATRIX_FILE_VERSION, dim))
+        values.tofile(f)
+
+
+def load_packed_values(path, use_mmap=False):
+    """
+    Loads the dimension and the packed values saved by save_packed_values.
+
+    With use_mmap, the file is memory-mapped copy-on-write and the values are a ctypes array of little-endian doubles
+    on it, which supports len, indexing and slicing without copying the file. Otherwise, the values are read into an
+    array.
+
+    Returns:
+        (tuple) dimension and packed values.
+    """
+    with open(path, "rb") as f:
+        magic, version, dim = MATRIX_FILE_HEADER.unpack(f.read(MATRIX_FILE_HEADER.size))
+        if magic != MATRIX_FILE_MAGIC or version != MATRIX_FILE_VERSION:
+            raise ValueError("{} is not a trip-in-trip-out-matrix file of version {}".format(path,
+                                                                                            MATRIX_FILE_VERSION))
+        size = get_packed_size(dim)
+        nb_value_bytes = os.fstat(f.fileno()).st_size - MATRIX_FILE_HEADER.size
+        if nb_value_bytes != size * MATRIX_FILE_VALUE_SIZE:
+            raise ValueError("{} contains {} bytes of values, but the dimension {} needs {}".format(
+                path, nb_value_bytes, dim, size * MATRIX_FILE_VALUE_SIZE))
+        if use_mmap:
+            mapped_file = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+            values = (ctypes.c_double.__ctype_le__ * size).from_buffer(mapped_file, MATRIX_FILE_HEADER.size)
+        else:
+            values = array("d")
+            values.fromfile(f, size)
+            if sys.byteorder == "big":
+                values.byteswap()
+    return dim, values
+
+
+def get_dim_of_packed_size(size):
+    """Dimension n of a matrix with size = n * (n + 1) / 2 packed values."""
+    dim = int((math.sqrt(8 * size + 1) - 1) / 2)
+    while get_packed_size(dim) < size:
+        dim += 1
+    if dim == 0 or get_packed_size(dim) != size:
+        raise ValueError("{} values do not form the upper triangle of a square matrix".format(size))
+    return dim
+
+
+def iter_packed_keys(dim):
+    """Iterates over the keys (i, j) in the order of the packed upper triangle."""
+    for i in range(1, dim + 1):
+        for j in range(i, dim + 1):
+            yield i, j
+
+
 def check_compatibility_of_tripintripout_matrices(matrix_1, matrix_2):
     if not isinstance(matrix_1, TripInTripOutMatrix):
         raise TypeError("must be a TripInTripOutMatrix-matrix: {}".format(matrix_1))
@@ -118,7 +840,7 @@ def check_compatibility_of_tripintripout_matrices(matrix_1, matrix_2):
 def create_unit_matrix(i, j, dim):
     if not 1 <= i <= dim or not 1 <= j <= dim:
         raise ValueError("{} and {} bust be between 1 and {}".format(i, j, dim))
-    matrix = TripInTripOutMatrix(dim)
+    matrix = SparseTripInTripOutMatrix(dim)
     matrix[i, j] = 1
     return matrix
 
@@ -133,28 +855,220 @@ def create_alpha(k_from, k_to, dim):
 
 
 def create_beta(k, dim):
-    matrix = TripInTripOutMatrix(dim)
-    for i in range(1, k + 1):
-        for j in range(k + 1, dim + 1):
-            matrix += create_unit_matrix(i, j, dim)
-    return matrix
+    if not 1 <= k < dim:
+        raise ValueError("1 <= {} < {} is violated".format(k, dim))
+    coefficients = [0.0] * (dim - 1)
+    coefficients[k - 1] = 1.0
+    return create_from_normal_space_coefficients(coefficients, dim)
 
 
 def get_beta_basis(dim):
     return [create_beta(i, dim) for i in range(1, dim)]
 
 
+def lru_cache(maxsize):
+    """Caches the results of a function of hashable arguments, keeping the maxsize most recently used ones."""
+    def decorator(function):
+        cache = OrderedDict()
+
+        @functools.wraps(function)
+        def wrapper(*args):
+            if args in cache:
+                result = cache.pop(args)
+            else:
+                result = function(*args)
+                if len(cache) >= maxsize:
+                    cache.popitem(last=False)
+            cache[args] = result
+            return result
+
+        wrapper.cache_clear = cache.clear
+        return wrapper
+
+    return decorator
+
+
+@lru_cache(maxsize=16)
+def _get_cached_orthonormal_basis_of_normal_space(dim):
+    return tuple(gram_schmidt(get_beta_basis(dim)))
+
+
 def get_orthonormal_basis_of_normal_space(dim):
-    return gram_schmidt(get_beta_basis(dim))
+    """Orthonormal basis of the span of the betas. The matrices are cached per dimension and must not be changed."""
+    return list(_get_cached_orthonormal_basis_of_normal_space(dim))
 
 
 def gram_schmidt(matrices):
-    m = len(matrices)
+    """Orthonormalizes the matrices by the modified Gram-Schmidt process, which is numerically stable."""
     new_matrices = []
-    for i in range(0, m):
-        act_matrix = matrices[i]
-        for j in range(0, i):
-            act_matrix += new_matrices[j].mult_by_scalar(-new_matrices[j].scalar_product(matrices[i]))
-        act_matrix = act_matrix.mult_by_scalar(1.0 / act_matrix.norm())
-        new_matrices += [act_matrix]
+    for matrix in matrices:
+        act_matrix = matrix.copy()
+        for new_matrix in new_matrices:
+            # project the already orthogonalized matrix instead of the original one
+            act_matrix.axpy(-new_matrix.dot(act_matrix), new_matrix)
+        act_matrix *= 1.0 / act_matrix.norm()
+        new_matrices += [act_matrix.prune()]
     return new_matrices
+
+
+def get_orthogonality_error(matrices):
+    """Maximal deviation of the scalar products of the matrices from the ones of an orthonormal system."""
+    error = 0.0
+    for i, matrix_i in enumerate(matrices):
+        for j in range(i, len(matrices)):
+            error = max(error, abs(matrix_i.dot(matrices[j]) - (1.0 if i == j else 0.0)))
+    return error
+
+
+def iter_calibration_jobs(path, delimiter=";"):
+    """
+    Reads the calibration jobs of a CSV file lazily.
+
+    The file has a header row and one row id;seed;volume_1;...;volume_(n-1) per job, where seed is the path of a
+    matrix saved by TripInTripOutMatrix.save, relative to the directory of the file. The recently used seeds are
+    kept loaded, so rows of the same seed load it once and yield the same values object.
+
+    Returns:
+        (generator) tuples (id, dimension, packed values of the seed matrix, calibration volumes).
+    """
+    directory = os.path.dirname(path)
+    load_seed = lru_cache(maxsize=SEED_CACHE_SIZE)(load_packed_values)
+    with open(path, "rb") as f:
+        reader = csv.reader(f, delimiter=delimiter)
+        next(reader, None)
+        for row in reader:
+            if not row:
+                continue
+            if len(row) < 2:
+                raise ValueError("row {} of {} has no seed".format(reader.line_num, path))
+            dim, values = load_seed(os.path.join(directory, row[1]))
+            calibration_volumes = [float(volume) for volume in row[2:]]
+            check_section_volumes(dim, calibration_volumes)
+            yield row[0], dim, values, calibration_volumes
+
+
+def _iter_job_chunks(jobs, chunk_size):
+    """
+    Groups consecutive jobs of the same seed matrix into tasks of at most chunk_size jobs for the workers.
+
+    The seed is sent once per task and decomposed once by calibrate_batch for all volumes of the task.
+    """
+    job_ids, calibration_volumes_list = [], []
+    chunk_dim = chunk_values = None
+    for job_id, dim, values, calibration_volumes in jobs:
+        if job_ids and (values is not chunk_values or len(job_ids) == chunk_size):
+            yield job_ids, (chunk_dim, [_as_array(chunk_values)], calibration_volumes_list)
+            job_ids, calibration_volumes_list = [], []
+        chunk_dim, chunk_values = dim, values
+        job_ids.append(job_id)
+        calibration_volumes_list.append(calibration_volumes)
+    if job_ids:
+        yield job_ids, (chunk_dim, [_as_array(chunk_values)], calibration_volumes_list)
+
+
+def _iter_calibrated_chunks(chunks, processes):
+    """
+    Calibrates the chunks on a pool of worker processes and yields them in order as (job ids, dimension, values).
+
+    At most two chunks per worker are in flight, such that the memory is bounded by the chunk size, whereas
+    Pool.imap would read all chunks ahead.
+    """
+    if processes == 1:
+        for job_ids, task in chunks:
+            yield job_ids, task[0], _calibrate_packed_chunk(task)
+        return
+    pool = multiprocessing.Pool(processes)
+    try:
+        pending = deque()
+        for job_ids, task in chunks:
+            pending.append((job_ids, task[0], pool.apply_async(_calibrate_packed_chunk, (task,))))
+            if len(pending) >= 2 * processes:
+                job_ids, dim, result = pending.popleft()
+                yield job_ids, dim, result.get()
+        while pending:
+            job_ids, dim, result = pending.popleft()
+            yield job_ids, dim, result.get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+class _BackgroundWriter(threading.Thread):
+    """Writes calibrated matrices from a bounded queue in a thread, such that the output overlaps the calibration."""
+
+    def __init__(self, output_dir, output_format, max_queue_size):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.output_dir = output_dir
+        self.output_format = output_format
+        self.queue = Queue(max_queue_size)
+        self.error = None
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            # after an error the queue is still emptied, such that the producer is not blocked
+            if self.error is None:
+                try:
+                    with instrumentation.timer("write"):
+                        self._write(*item)
+                except Exception as e:
+                    self.error = e
+
+    def _write(self, job_id, dim, values):
+        if self.output_format == "binary":
+            save_packed_values(os.path.join(self.output_dir, "{}.tito".format(job_id)), values, dim)
+        else:
+            with open(os.path.join(self.output_dir, "{}.csv".format(job_id)), "w") as f:
+                TripInTripOutMatrix._from_values(dim, values).write_csv(f)
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Calibrates seed matrices to section volumes.")
+    parser.add_argument("jobs", help="CSV file with a header and rows id;seed;volume_1;...;volume_(n-1), see "
+                                     "iter_calibration_jobs")
+    parser.add_argument("output_dir", help="directory of the calibrated matrices, one file <id>.csv or <id>.tito "
+                                           "per job")
+    parser.add_argument("--format", choices=["csv", "binary"], default="csv", help="format of the calibrated matrices")
+    parser.add_argument("--processes", type=int, help="number of worker processes, by default the number of CPUs")
+    parser.add_argument("--chunk-size", type=int, default=64, help="maximal number of jobs per task sent to a worker")
+    parser.add_argument("--profile", help="path of a JSON report with the time and memory per stage")
+    options = parser.parse_args(args)
+    if not options.chunk_size > 0:
+        parser.error("chunk size must be > 0, but is {}".format(options.chunk_size))
+    instrumentation.enable(options.profile is not None)
+    processes = options.processes or multiprocessing.cpu_count()
+    if not os.path.isdir(options.output_dir):
+        os.makedirs(options.output_dir)
+
+    writer = _BackgroundWriter(options.output_dir, options.format, 2 * processes * options.chunk_size)
+    writer.start()
+    start = time.time()
+    nb_matrices = 0
+    try:
+        with instrumentation.timer("calibrate"):
+            chunks = _iter_job_chunks(iter_calibration_jobs(options.jobs), options.chunk_size)
+            for job_ids, dim, values_list in _iter_calibrated_chunks(chunks, processes):
+                for job_id, values in zip(job_ids, values_list):
+                    writer.queue.put((job_id, dim, values))
+                nb_matrices += len(job_ids)
+                if writer.error is not None:
+                    break
+    finally:
+        writer.queue.put(None)
+        writer.join()
+    if writer.error is not None:
+        raise writer.error
+    seconds = time.time() - start
+    instrumentation.count("matrices", nb_matrices)
+    sys.stderr.write("calibrated {} matrices in {:.3f}s ({:.1f} matrices/s)\n".format(
+        nb_matrices, seconds, nb_matrices / seconds if seconds > 0 else float("inf")))
+    if options.profile:
+        instrumentation.get_instrumentation().write_report(options.profile)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
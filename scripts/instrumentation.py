@@ -0,0 +1,108 @@
+import csv
+import json
+import resource
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+"""
+Named timers and counters for the stages of the scripts.
+
+The instrumentation is disabled by default, then timer and count do nothing. The __main__ blocks enable it with
+--profile and write a JSON report with the wall time, the peak memory and the item counts per stage.
+"""
+
+WRITE_CHUNK_SIZE = 4096
+
+
+class Instrumentation(object):
+    """Accumulates the wall time and number of calls per named stage and the values of named counters."""
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._start = time.time()
+        self._stages = OrderedDict()
+        self._counters = OrderedDict()
+
+    @contextmanager
+    def timer(self, name):
+        """Context manager measuring the wall time of a stage. A stage may be entered several times."""
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            stage = self._stages.setdefault(name, {"name": name, "seconds": 0.0, "calls": 0})
+            stage["seconds"] += time.time() - start
+            stage["calls"] += 1
+            stage["peak_rss_kb"] = get_peak_rss_kb()
+
+    def count(self, name, nb=1):
+        if self.enabled:
+            self._counters[name] = self._counters.get(name, 0) + nb
+
+    def get_report(self):
+        return {
+            "total_seconds": time.time() - self._start,
+            "peak_rss_kb": get_peak_rss_kb(),
+            "stages": [dict(stage) for stage in self._stages.values()],
+            "counts": dict(self._counters),
+        }
+
+    def write_report(self, path):
+        with open(path, "w") as f:
+            json.dump(self.get_report(), f, indent=2, sort_keys=True)
+            f.write("\n")
+
+
+_instrumentation = Instrumentation()
+
+
+def get_instrumentation():
+    return _instrumentation
+
+
+def enable(enabled=True):
+    """Enables the global instrumentation and resets its timers and counters."""
+    global _instrumentation
+    _instrumentation = Instrumentation(enabled)
+    return _instrumentation
+
+
+def timer(name):
+    return _instrumentation.timer(name)
+
+
+def count(name, nb=1):
+    _instrumentation.count(name, nb)
+
+
+def get_peak_rss_kb():
+    """Peak resident set size of the process, in kilobytes on Linux."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def write_rows(f, rows, delimiter=";", chunk_size=WRITE_CHUNK_SIZE):
+    """
+    Writes the rows with a csv writer on the file, in chunks of rows passed to writerows.
+
+    Values containing the delimiter, quotes or line breaks are quoted as by the csv module.
+
+    Returns:
+        (int) number of written rows.
+    """
+    writer = csv.writer(f, delimiter=delimiter, lineterminator="\n")
+    chunk = []
+    nb_rows = 0
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            writer.writerows(chunk)
+            nb_rows += len(chunk)
+            chunk = []
+    if chunk:
+        writer.writerows(chunk)
+        nb_rows += len(chunk)
+    return nb_rows
@@ -0,0 +1,209 @@
+import hashlib
+import os
+import pickle
+import tempfile
+from array import array
+
+from scripts import instrumentation
+from scripts.stop_graph import StopGraph
+
+"""
+A persistent cache of function results on disk, keyed by a fingerprint of the function and its arguments.
+
+Unchanged inputs skip the recomputation, e.g. when the daily exports of a network did not change. The entries are
+pickle files in a directory, which is limited in size by evicting the least recently used entries.
+"""
+
+# part of each fingerprint, to be increased if the results of the cached functions change for the same input
+CACHE_VERSION = 1
+DEFAULT_MAX_SIZE_BYTES = 1 << 30
+CACHE_FILE_SUFFIX = ".pickle"
+
+
+class ResultCache(object):
+    """
+    Content-addressed cache of function results in a directory.
+
+    The key of a call is the SHA-256 hash of a canonical encoding of the function name, the digest of its bytecode
+    and the arguments, in which dicts and sets are sorted, so the key does not depend on their iteration order. A
+    changed function misses the old entries, but changes of the functions it calls still require a new
+    CACHE_VERSION. A hit updates the
+    modification time of the entry, which is used as the time of last use by the eviction.
+    """
+
+    def __init__(self, directory, max_size_bytes=DEFAULT_MAX_SIZE_BYTES):
+        if not max_size_bytes > 0:
+            raise ValueError("maximal size must be > 0, but is {}".format(max_size_bytes))
+        self.directory = directory
+        self.max_size_bytes = max_size_bytes
+        self.nb_hits = 0
+        self.nb_misses = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def call(self, function, *args, **kwargs):
+        """Returns the cached result of function(*args, **kwargs), computing and storing it on a miss."""
+        with instrumentation.timer("cache lookup"):
+            key = get_fingerprint(CACHE_VERSION, function.__module__, function.__name__, _get_code_digest(function),
+                                  args, kwargs)
+            hit, result = self.get(key)
+        if hit:
+            return result
+        result = function(*args, **kwargs)
+        with instrumentation.timer("cache store"):
+            self.put(key, result)
+        return result
+
+    def get(self, key):
+        """Returns a pair (whether the key is cached, cached value or None)."""
+        path = self._get_path(key)
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+        except (IOError, OSError):
+            return self._count_miss()
+        except Exception:
+            # a corrupt entry, e.g. written by an incompatible version, is removed
+            self._remove(path)
+            return self._count_miss()
+        try:
+            os.utime(path, None)
+        except OSError:
+            # the entry was evicted by another process after it was loaded
+            pass
+        self.nb_hits += 1
+        instrumentation.count("cache hits")
+        return True, value
+
+    def put(self, key, value):
+        """Stores the value atomically, such that concurrent readers never see a partial entry, and evicts."""
+        file_descriptor, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(file_descriptor, "wb") as f:
+                pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(temp_path, self._get_path(key))
+        except Exception:
+            self._remove(temp_path)
+            raise
+        self.evict()
+
+    def evict(self):
+        """Removes the least recently used entries until the entries take at most max_size_bytes."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(CACHE_FILE_SUFFIX):
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size_bytes:
+                break
+            self._remove(path)
+            total_size -= size
+
+    def get_summary(self):
+        return "result cache: {} hits, {} misses".format(self.nb_hits, self.nb_misses)
+
+    def _get_path(self, key):
+        return os.path.join(self.directory, key + CACHE_FILE_SUFFIX)
+
+    def _count_miss(self):
+        self.nb_misses += 1
+        instrumentation.count("cache misses")
+        return False, None
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def call_cached(result_cache, function, *args, **kwargs):
+    """Calls the function through the result cache, or directly if the cache is None."""
+    if result_cache is None:
+        return function(*args, **kwargs)
+    return result_cache.call(function, *args, **kwargs)
+
+
+def _get_code_digest(function):
+    """SHA-256 hex digest of the bytecode of the function, None for functions without bytecode like builtins."""
+    code = getattr(function, "__code__", None)
+    if code is None:
+        return None
+    hash_object = hashlib.sha256()
+    _update_code_hash(hash_object, code)
+    return hash_object.hexdigest()
+
+
+def _update_code_hash(hash_object, code):
+    """Feeds the instructions, names and constants of a code object, including nested ones, into the hash object."""
+    hash_object.update(code.co_code)
+    _update_hash(hash_object, code.co_names)
+    for constant in code.co_consts:
+        if hasattr(constant, "co_code"):
+            _update_code_hash(hash_object, constant)
+        else:
+            _update_hash(hash_object, constant)
+
+
+def get_fingerprint(*values):
+    """SHA-256 hex digest of the canonical encoding of the values."""
+    hash_object = hashlib.sha256()
+    _update_hash(hash_object, values)
+    return hash_object.hexdigest()
+
+
+def _get_digest(value):
+    hash_object = hashlib.sha256()
+    _update_hash(hash_object, value)
+    return hash_object.digest()
+
+
+def _update_hash(hash_object, value):
+    """
+    Feeds a canonical encoding of the value into the hash object, which is equal for equal values.
+
+    The encoding is fed part by part instead of being built as one string. The elements of dicts and sets are encoded
+    by their sorted digests. Arrays are encoded by their type code and bytes, a StopGraph by its stops and compressed
+    rows, other objects with attributes by their class name and attributes.
+    """
+    if isinstance(value, dict):
+        hash_object.update(b"{")
+        for digest in sorted(_get_digest((key, item)) for key, item in value.items()):
+            hash_object.update(digest)
+        hash_object.update(b"}")
+    elif isinstance(value, (set, frozenset)):
+        hash_object.update(b"set(")
+        for digest in sorted(_get_digest(element) for element in value):
+            hash_object.update(digest)
+        hash_object.update(b")")
+    elif isinstance(value, (list, tuple)):
+        brackets = b"[]" if isinstance(value, list) else b"()"
+        hash_object.update(brackets[:1])
+        for element in value:
+            _update_hash(hash_object, element)
+            hash_object.update(b",")
+        hash_object.update(brackets[1:])
+    elif isinstance(value, array):
+        data = value.tostring() if hasattr(value, "tostring") else value.tobytes()
+        hash_object.update("array('{}',{}:".format(value.typecode, len(data)).encode("utf-8"))
+        hash_object.update(data)
+        hash_object.update(b")")
+    elif isinstance(value, StopGraph):
+        # id_per_stop is derived from the stops
+        hash_object.update(b"StopGraph(")
+        for part in (value.stops, value.successor_offsets, value.successor_targets, value.predecessor_offsets,
+                     value.predecessor_targets):
+            _update_hash(hash_object, part)
+        hash_object.update(b")")
+    elif hasattr(value, "__dict__") and not callable(value):
+        hash_object.update(type(value).__name__.encode("utf-8"))
+        _update_hash(hash_object, vars(value))
+    else:
+        hash_object.update(repr(value).encode("utf-8"))
@@ -1,30 +1,408 @@
-import csv
+import argparse
+import random
 import sys
+from array import array
 from collections import defaultdict
+from itertools import chain
+
+from scripts import instrumentation
+from scripts.result_cache import ResultCache, call_cached
+from scripts.visum_att import iter_routes
 
 """A script for aggregating routes with common stops."""
 
+# Mersenne prime 2^31 - 1, the modulus of the universal hash functions of the MinHash signatures, small enough that
+# the products of the hash function stay machine integers
+MINHASH_PRIME = (1 << 31) - 1
+
 
 def aggregate_routes(route_per_id, nb_subsequent_stops=3):
     """Aggregates the routes if they have at least nb_subsequent common consecutive stops."""
-    routes_per_subsequent_stop_tuples = get_routes_per_subsequent_stop_tuples(route_per_id, nb_subsequent_stops)
-    route_group_per_route = {}
-    for route in route_per_id:
-        route_group_per_route[route] = {route}
-    for routes_to_aggregate in routes_per_subsequent_stop_tuples.values():
-        routes_to_aggregate_list = list(routes_to_aggregate)
-        nb_routes = len(routes_to_aggregate_list)
-        for ind in range(nb_routes):
-            for j in range(ind, nb_routes):
-                route_1 = routes_to_aggregate_list[ind]
-                route_2 = routes_to_aggregate_list[j]
-                route_group_1 = route_group_per_route[route_1]
-                route_group_2 = route_group_per_route[route_2]
-                if route_group_1 is not route_group_2:
-                    new_route_group = route_group_1.union(route_group_2)
-                    for a_route in new_route_group:
-                        route_group_per_route[a_route] = new_route_group
-    return frozenset([frozenset(s) for s in route_group_per_route.values()])
+    with instrumentation.timer("index build"):
+        stop_sequence_index = StopSequenceIndex(route_per_id, nb_subsequent_stops)
+    with instrumentation.timer("merge"):
+        route_groups = UnionFind(route_per_id)
+        for routes_to_aggregate in stop_sequence_index.iter_shared_routes():
+            first_route = routes_to_aggregate[0]
+            for route in routes_to_aggregate[1:]:
+                route_groups.union(first_route, route)
+        return route_groups.get_groups()
+
+
+def aggregate_routes_multi(route_per_id, thresholds):
+    """
+    Aggregates the routes for several values of nb_subsequent_stops at once.
+
+    Routes sharing k + 1 consecutive stops also share k consecutive stops, so the groupings are nested. The
+    occurrences (route, position) of common stop sequences are refined stop by stop into the occurrences of the
+    longer sequences. Then the groups are merged from the largest threshold down to the smallest one with a single
+    union-find structure.
+
+    Args:
+        route_per_id (dict): stops per route.
+        thresholds (list): values of nb_subsequent_stops.
+
+    Returns:
+        (dict) aggregated routes as in aggregate_routes per threshold.
+    """
+    thresholds = sorted(set(thresholds))
+    if not thresholds:
+        return {}
+    if not thresholds[0] > 0:
+        raise ValueError("thresholds must be > 0, but are {}".format(thresholds))
+
+    routes_to_merge_per_threshold = defaultdict(list)
+    occurrences_per_stop = defaultdict(list)
+    for route_id, route_stops in route_per_id.items():
+        for position, stop in enumerate(route_stops):
+            occurrences_per_stop[stop].append((route_id, position))
+    occurrence_classes = _get_shared_occurrence_classes(occurrences_per_stop.values())
+    for nb_subsequent_stops in range(1, thresholds[-1] + 1):
+        if nb_subsequent_stops > 1:
+            occurrence_classes = _get_shared_occurrence_classes(chain.from_iterable(
+                _refine_occurrence_class(occurrence_class, route_per_id, nb_subsequent_stops - 1)
+                for occurrence_class in occurrence_classes))
+        if not occurrence_classes:
+            break
+        if nb_subsequent_stops in thresholds:
+            routes_to_merge_per_threshold[nb_subsequent_stops] = [
+                list({route_id for route_id, _ in occurrence_class}) for occurrence_class in occurrence_classes]
+
+    route_groups = UnionFind(route_per_id)
+    res = {}
+    for nb_subsequent_stops in reversed(thresholds):
+        for routes_to_aggregate in routes_to_merge_per_threshold[nb_subsequent_stops]:
+            for route in routes_to_aggregate[1:]:
+                route_groups.union(routes_to_aggregate[0], route)
+        res[nb_subsequent_stops] = route_groups.get_groups()
+    return res
+
+
+def _refine_occurrence_class(occurrence_class, route_per_id, length):
+    """Splits the occurrences of a stop sequence of the given length by the stop following the sequence."""
+    occurrences_per_next_stop = defaultdict(list)
+    for route_id, position in occurrence_class:
+        route_stops = route_per_id[route_id]
+        if position + length < len(route_stops):
+            occurrences_per_next_stop[route_stops[position + length]].append((route_id, position))
+    return occurrences_per_next_stop.values()
+
+
+def _get_shared_occurrence_classes(occurrence_classes):
+    """Keeps the classes of occurrences which belong to at least two different routes."""
+    res = []
+    for occurrence_class in occurrence_classes:
+        first_route_id = occurrence_class[0][0]
+        if any(route_id != first_route_id for route_id, _ in occurrence_class):
+            res.append(occurrence_class)
+    return res
+
+
+def aggregate_routes_fuzzy(route_per_id, jaccard_threshold=0.5, nb_subsequent_stops=2, nb_hashes=64, nb_bands=None,
+                           seed=0):
+    """
+    Aggregates the routes whose sets of sequences of nb_subsequent_stops consecutive stops are similar.
+
+    Two routes are similar if the Jaccard index of their stop sequences is at least jaccard_threshold, so an inserted
+    or skipped stop does not break the match. The similarity is transitive as in aggregate_routes. Candidate pairs
+    are found by locality-sensitive hashing: the MinHash signature of each route is split into nb_bands bands and
+    routes with an equal band share a bucket. Each route of a bucket is verified by the exact Jaccard index against
+    the last route of each other group in the bucket, which keeps a bucket of similar routes linear. So a similar pair
+    is missed if it shares no bucket, or if the route is only similar to other routes of a group than the compared
+    one, but no pair is merged wrongly. More bands find more candidates at the cost of more comparisons.
+
+    Args:
+        route_per_id (dict): stops per route.
+        jaccard_threshold (float): minimal Jaccard index of similar routes in (0, 1].
+        nb_subsequent_stops (int): length of the compared stop sequences.
+        nb_hashes (int): length of the MinHash signatures.
+        nb_bands (int): number of bands, a divisor of nb_hashes. By default it is chosen such that the probability
+            of a pair to become a candidate is 1/2 at about the jaccard_threshold.
+        seed (int): seed of the hash functions, the result is the same for the same seed.
+
+    Returns:
+        (frozenset) aggregated routes as in aggregate_routes.
+    """
+    if not 0.0 < jaccard_threshold <= 1.0:
+        raise ValueError("jaccard threshold must be in (0, 1], but is {}".format(jaccard_threshold))
+    if not nb_subsequent_stops > 0:
+        raise ValueError("number of subsequent stops must be > 0, but is {}".format(nb_subsequent_stops))
+    if nb_bands is None:
+        nb_bands = _get_nb_bands(nb_hashes, jaccard_threshold)
+    if not 0 < nb_bands <= nb_hashes or nb_hashes % nb_bands:
+        raise ValueError("number of bands must divide the number of hashes {}, but is {}".format(nb_hashes, nb_bands))
+    nb_rows = nb_hashes // nb_bands
+
+    with instrumentation.timer("index build"):
+        # routes with equal stop sequences are aggregated anyway, so only one route per set of sequences is hashed
+        id_per_sequence = {}
+        route_ids_per_sequence_ids = defaultdict(list)
+        for route_id, route_stops in route_per_id.items():
+            sequences = get_subsequent_stop_tuples(tuple(route_stops), nb_subsequent_stops) or {tuple(route_stops)}
+            sequence_ids = frozenset(id_per_sequence.setdefault(sequence, len(id_per_sequence))
+                                     for sequence in sequences)
+            route_ids_per_sequence_ids[sequence_ids].append(route_id)
+        rnd = random.Random(seed)
+        hash_functions = [(rnd.randrange(1, MINHASH_PRIME), rnd.randrange(MINHASH_PRIME)) for _ in range(nb_hashes)]
+        bucket_per_key = defaultdict(list)
+        for sequence_ids in route_ids_per_sequence_ids:
+            signature = tuple([min([(a * sequence_id + b) % MINHASH_PRIME for sequence_id in sequence_ids])
+                               for a, b in hash_functions])
+            for band in range(nb_bands):
+                bucket_per_key[band, signature[band * nb_rows:(band + 1) * nb_rows]].append(sequence_ids)
+
+    with instrumentation.timer("merge"):
+        route_groups = UnionFind(route_per_id)
+        for route_ids in route_ids_per_sequence_ids.values():
+            for route_id in route_ids[1:]:
+                route_groups.union(route_ids[0], route_id)
+        for bucket in bucket_per_key.values():
+            # one representative per group in the bucket, so a bucket of similar routes, e.g. sharing a trunk, is
+            # merged in linear time instead of comparing all pairs
+            representative_per_root = {}
+            for sequence_ids in bucket:
+                route_id = route_ids_per_sequence_ids[sequence_ids][0]
+                own_root = route_groups.find(route_id)
+                matched_roots = [root for root, other_sequence_ids in representative_per_root.items()
+                                 if root != own_root and
+                                 _get_jaccard_index(sequence_ids, other_sequence_ids) >= jaccard_threshold]
+                for root in matched_roots:
+                    route_groups.union(route_id, root)
+                    del representative_per_root[root]
+                # the route replaces the representative of its group, which it has not been compared with
+                representative_per_root.pop(own_root, None)
+                representative_per_root[route_groups.find(route_id)] = sequence_ids
+        return route_groups.get_groups()
+
+
+def _get_nb_bands(nb_hashes, jaccard_threshold):
+    """Chooses the divisor b of nb_hashes, such that the LSH threshold (1 / b)^(1 / r) is closest to the given one."""
+    return min((nb_bands for nb_bands in range(1, nb_hashes + 1) if nb_hashes % nb_bands == 0),
+               key=lambda nb_bands: abs((1.0 / nb_bands) ** (float(nb_bands) / nb_hashes) - jaccard_threshold))
+
+
+def _get_jaccard_index(set_1, set_2):
+    return len(set_1 & set_2) / float(len(set_1 | set_2))
+
+
+class StopSequenceIndex(object):
+    """
+    Index of the routes per sequence of nb_subsequent_stops consecutive stops.
+
+    The stops are mapped to consecutive integers and each sequence is encoded as one integer key, which is computed
+    by a rolling bit shift over the route. Each stop takes as many bits as the largest stop id, so the keys stay
+    machine-sized integers, e.g. up to 2^21 stops for sequences of 3 stops. Per key, the indices of the routes
+    containing the sequence are stored in an array. The indices of removed routes are reused by the next added routes.
+    """
+
+    def __init__(self, route_per_id=None, nb_subsequent_stops=3):
+        if not nb_subsequent_stops > 0:
+            raise ValueError("number of subsequent stops must be > 0, but is {}".format(nb_subsequent_stops))
+        self.nb_subsequent_stops = nb_subsequent_stops
+        self._id_per_stop = {}
+        self._route_ids = []
+        self._index_per_route_id = {}
+        self._stop_ids_per_route = []
+        self._free_route_indices = []
+        self._route_indices_per_key = {}
+        route_per_id = route_per_id or {}
+        # the stops of the initial routes are mapped first, such that the keys are not rebuilt while adding them
+        for route_stops in route_per_id.values():
+            for stop in route_stops:
+                self._get_stop_id(stop)
+        self._bits_per_stop = self._get_bits_per_stop()
+        for route_id, route_stops in route_per_id.items():
+            self.add_route(route_id, route_stops)
+
+    def __len__(self):
+        return len(self._route_indices_per_key)
+
+    def add_route(self, route_id, route_stops):
+        if route_id in self._index_per_route_id:
+            raise ValueError("route {} is already in the index".format(route_id))
+        stop_ids = array("l", [self._get_stop_id(stop) for stop in route_stops])
+        bits_per_stop = self._get_bits_per_stop()
+        if bits_per_stop > self._bits_per_stop:
+            self._bits_per_stop = bits_per_stop
+            self._rebuild_keys()
+        if self._free_route_indices:
+            route_index = self._free_route_indices.pop()
+            self._route_ids[route_index] = route_id
+            self._stop_ids_per_route[route_index] = stop_ids
+        else:
+            route_index = len(self._route_ids)
+            self._route_ids.append(route_id)
+            self._stop_ids_per_route.append(stop_ids)
+        self._index_per_route_id[route_id] = route_index
+        self._add_keys(route_index)
+
+    def remove_route(self, route_id):
+        route_index = self._index_per_route_id.pop(route_id)
+        for key in set(self._iter_keys(self._stop_ids_per_route[route_index])):
+            route_indices = self._route_indices_per_key[key]
+            route_indices.remove(route_index)
+            if not route_indices:
+                del self._route_indices_per_key[key]
+        self._route_ids[route_index] = None
+        self._stop_ids_per_route[route_index] = array("l")
+        self._free_route_indices.append(route_index)
+
+    def get_neighbour_routes(self, route_id):
+        """Returns the ids of the other routes sharing at least one stop sequence with the given route."""
+        route_index = self._index_per_route_id[route_id]
+        neighbour_indices = set()
+        for key in self._iter_keys(self._stop_ids_per_route[route_index]):
+            neighbour_indices.update(self._route_indices_per_key[key])
+        neighbour_indices.discard(route_index)
+        return {self._route_ids[ind] for ind in neighbour_indices}
+
+    def get_routes(self, stop_sequence):
+        """Returns the ids of the routes containing the given sequence of stops."""
+        if len(stop_sequence) != self.nb_subsequent_stops:
+            raise ValueError("stop sequence must have length {}: {}".format(self.nb_subsequent_stops, stop_sequence))
+        if not all(stop in self._id_per_stop for stop in stop_sequence):
+            return set()
+        keys = list(self._iter_keys([self._id_per_stop[stop] for stop in stop_sequence]))
+        return {self._route_ids[ind] for ind in self._route_indices_per_key.get(keys[0], [])}
+
+    def iter_shared_routes(self):
+        """Yields the ids of the routes per stop sequence which is contained in at least two routes."""
+        for route_indices in self._route_indices_per_key.values():
+            if len(route_indices) > 1:
+                yield [self._route_ids[ind] for ind in route_indices]
+
+    def _get_stop_id(self, stop):
+        stop_id = self._id_per_stop.get(stop)
+        if stop_id is None:
+            stop_id = len(self._id_per_stop)
+            self._id_per_stop[stop] = stop_id
+        return stop_id
+
+    def _get_bits_per_stop(self):
+        return max(1, (len(self._id_per_stop) - 1).bit_length())
+
+    def _iter_keys(self, stop_ids):
+        bits_per_stop = self._bits_per_stop
+        mask = (1 << (bits_per_stop * self.nb_subsequent_stops)) - 1
+        key = 0
+        for ind, stop_id in enumerate(stop_ids):
+            key = ((key << bits_per_stop) | stop_id) & mask
+            if ind >= self.nb_subsequent_stops - 1:
+                yield key
+
+    def _add_keys(self, route_index):
+        for key in self._iter_keys(self._stop_ids_per_route[route_index]):
+            route_indices = self._route_indices_per_key.get(key)
+            if route_indices is None:
+                self._route_indices_per_key[key] = array("l", [route_index])
+            elif route_indices[-1] != route_index:
+                route_indices.append(route_index)
+
+    def _rebuild_keys(self):
+        self._route_indices_per_key = {}
+        for route_index in range(len(self._route_ids)):
+            self._add_keys(route_index)
+
+
+class RouteAggregator(object):
+    """
+    Aggregated routes (see aggregate_routes), which are kept up to date while single routes change.
+
+    Adding a route only looks at the routes sharing a stop sequence with it. Removing a route only splits the group
+    it belonged to.
+    """
+
+    def __init__(self, route_per_id=None, nb_subsequent_stops=3):
+        self._stop_sequence_index = StopSequenceIndex(nb_subsequent_stops=nb_subsequent_stops)
+        self._route_group_per_route = {}
+        for route_id, route_stops in (route_per_id or {}).items():
+            self.add_route(route_id, route_stops)
+
+    def add_route(self, route_id, route_stops):
+        self._stop_sequence_index.add_route(route_id, route_stops)
+        self._route_group_per_route[route_id] = {route_id}
+        for neighbour_route in self._stop_sequence_index.get_neighbour_routes(route_id):
+            self._merge_route_groups(route_id, neighbour_route)
+
+    def update_route(self, route_id, route_stops):
+        self.remove_route(route_id)
+        self.add_route(route_id, route_stops)
+
+    def remove_route(self, route_id):
+        route_group = self._route_group_per_route.pop(route_id)
+        self._stop_sequence_index.remove_route(route_id)
+        route_group.discard(route_id)
+        # the remaining routes of the group may fall apart into several groups
+        unvisited_routes = set(route_group)
+        while unvisited_routes:
+            start_route = unvisited_routes.pop()
+            new_route_group = {start_route}
+            routes_to_visit = [start_route]
+            while routes_to_visit:
+                for neighbour_route in self._stop_sequence_index.get_neighbour_routes(routes_to_visit.pop()):
+                    if neighbour_route in unvisited_routes:
+                        unvisited_routes.remove(neighbour_route)
+                        new_route_group.add(neighbour_route)
+                        routes_to_visit.append(neighbour_route)
+            for a_route in new_route_group:
+                self._route_group_per_route[a_route] = new_route_group
+
+    def get_groups(self):
+        """Returns the aggregated routes as frozenset of frozensets, like aggregate_routes."""
+        return frozenset([frozenset(s) for s in self._route_group_per_route.values()])
+
+    def _merge_route_groups(self, route_1, route_2):
+        route_group_1 = self._route_group_per_route[route_1]
+        route_group_2 = self._route_group_per_route[route_2]
+        if route_group_1 is route_group_2:
+            return
+        if len(route_group_1) < len(route_group_2):
+            route_group_1, route_group_2 = route_group_2, route_group_1
+        route_group_1.update(route_group_2)
+        for a_route in route_group_2:
+            self._route_group_per_route[a_route] = route_group_1
+
+
+class UnionFind(object):
+    """Disjoint sets of hashable elements with path compression and union by rank."""
+
+    def __init__(self, elements=()):
+        self._parent = {}
+        self._rank = {}
+        for element in elements:
+            self.add(element)
+
+    def add(self, element):
+        if element not in self._parent:
+            self._parent[element] = element
+            self._rank[element] = 0
+
+    def find(self, element):
+        root = element
+        while self._parent[root] != root:
+            root = self._parent[root]
+        while self._parent[element] != root:
+            self._parent[element], element = root, self._parent[element]
+        return root
+
+    def union(self, element_1, element_2):
+        root_1 = self.find(element_1)
+        root_2 = self.find(element_2)
+        if root_1 == root_2:
+            return root_1
+        if self._rank[root_1] < self._rank[root_2]:
+            root_1, root_2 = root_2, root_1
+        self._parent[root_2] = root_1
+        if self._rank[root_1] == self._rank[root_2]:
+            self._rank[root_1] += 1
+        return root_1
+
+    def get_groups(self):
+        """Returns the disjoint sets as frozenset of frozensets."""
+        elements_per_root = defaultdict(set)
+        for element in self._parent:
+            elements_per_root[self.find(element)].add(element)
+        return frozenset([frozenset(s) for s in elements_per_root.values()])
 
 
 def get_routes_per_subsequent_stop_tuples(route_per_id, nb_subsequent_stops):
@@ -45,27 +423,55 @@ def get_subsequent_stop_tuples(route_stops, nb_subsequent_stops):
 
 
 def get_routes_from_visum_att_file(path_to_visum_att_file):
-    """Creates the routes from a Visum-TIMEPROFILEITEM-attribute-file."""
-    with open(path_to_visum_att_file) as f:
-        for _ in range(12):
-            f.next()
-        _route_per_id = defaultdict(list)
-        reader = csv.DictReader(f, delimiter=";")
-        for tpi in reader:
-            _route_per_id[int(tpi["TIMEPROFILEID"])] += [int(tpi[r"LINEROUTEITEM\STOPPOINT\STOPAREA\STOP\NO"])]
+    """Creates the routes from a (possibly gzip compressed) Visum-TIMEPROFILEITEM-attribute-file."""
+    _route_per_id = defaultdict(list)
+    for (tp_id,), stops in iter_routes(path_to_visum_att_file, ["TIMEPROFILEID"],
+                                       r"LINEROUTEITEM\STOPPOINT\STOPAREA\STOP\NO"):
+        _route_per_id[int(tp_id)] += [int(stop) for stop in stops]
     res = {}
     for tp_id in _route_per_id:
         res[tp_id] = tuple(_route_per_id[tp_id])
     return res
 
 
+def main(args):
+    parser = argparse.ArgumentParser(description="Aggregates the time profiles of a Visum attribute file.")
+    parser.add_argument("path_in", help="Visum TIMEPROFILEITEM attribute file, may be gzip compressed")
+    parser.add_argument("--output", help="path of the lines 'group;time profile id', written to stdout if not given")
+    parser.add_argument("--nb-subsequent-stops", type=int, default=3)
+    parser.add_argument("--jaccard-threshold", type=float,
+                        help="aggregate routes with similar stop sequences, see aggregate_routes_fuzzy")
+    parser.add_argument("--profile", help="path of a JSON report with the time and memory per stage")
+    parser.add_argument("--cache-dir", help="directory of a persistent cache of the results per input")
+    options = parser.parse_args(args)
+    instrumentation.enable(options.profile is not None)
+    result_cache = ResultCache(options.cache_dir) if options.cache_dir else None
+
+    with instrumentation.timer("parse"):
+        route_per_id = get_routes_from_visum_att_file(options.path_in)
+    instrumentation.count("timeprofiles", len(route_per_id))
+    instrumentation.count("timeprofileitems", sum(len(route) for route in route_per_id.values()))
+    if options.jaccard_threshold is None:
+        aggregated_routes = call_cached(result_cache, aggregate_routes, route_per_id,
+                                        nb_subsequent_stops=options.nb_subsequent_stops)
+    else:
+        aggregated_routes = call_cached(result_cache, aggregate_routes_fuzzy, route_per_id,
+                                        jaccard_threshold=options.jaccard_threshold,
+                                        nb_subsequent_stops=options.nb_subsequent_stops)
+    instrumentation.count("timeprofile-groups", len(aggregated_routes))
+    with instrumentation.timer("write"):
+        rows = ((ind, route_id) for ind, route_group in enumerate(aggregated_routes) for route_id in route_group)
+        if options.output:
+            with open(options.output, "w") as f:
+                instrumentation.write_rows(f, rows)
+        else:
+            instrumentation.write_rows(sys.stdout, rows)
+    if result_cache is not None:
+        sys.stderr.write(result_cache.get_summary() + "\n")
+    if options.profile:
+        instrumentation.get_instrumentation().write_report(options.profile)
+    return 0
+
+
 if __name__ == "__main__":
-    path_to_att_file = sys.argv[1]
-    route_per_id_from_visum = get_routes_from_visum_att_file(path_to_att_file)
-    print "#timeprofiles: {}".format(len(route_per_id_from_visum))
-    print "#timeprofileitems: {}".format(sum([len(e) for e in route_per_id_from_visum.values()]))
-    aggregated_routes = aggregate_routes(route_per_id_from_visum, nb_subsequent_stops=3)
-    print "#timeprofile-groups: {}".format(len(aggregated_routes))
-    for i, gr in enumerate(aggregated_routes):
-        for fzp in gr:
-            print "{};{}".format(i, fzp)
+    sys.exit(main(sys.argv[1:]))
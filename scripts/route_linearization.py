@@ -1,114 +1,496 @@
-import csv
+import argparse
+import heapq
+import multiprocessing
 import sys
-from collections import defaultdict
-from collections import deque
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, defaultdict
+from itertools import chain
 
-"""A script to sort the vertices in a connected directed acyclic graph in a linear order."""
+from scripts import instrumentation
+from scripts.result_cache import ResultCache, call_cached
+from scripts.stop_graph import StopGraph
+from scripts.visum_att import iter_routes
+
+"""A script to sort the vertices in a directed acyclic graph in a linear order."""
+
+BACKWARD_EDGE_PENALTY = 10
+
+
+class CycleError(ValueError):
+    """Raised if the stops cannot be sorted in a linear order, because the graph contains a cycle."""
+
+    def __init__(self, stops):
+        super(CycleError, self).__init__("the stops contain a cycle: {}".format(stops))
+        self.stops = stops
 
 
 def linearize_stops_in_multiple_routes(successors_per_stop):
     """
     Sorts the stops (vertices) in a linear order.
 
+    The order is built iteratively by Kahn's algorithm: a stop is placed as soon as all its predecessors are placed.
+    The stops which become ready are placed first, such that the stops of a route stay together where possible. Ties
+    are broken by the ids of the stops in the graph, so the order is the same for the same input.
+
     Restrictions:
-        - Loops are not allowed.
-        - The undirected graph must be connected.
+        - Loops are not allowed, a CycleError with the stops of a cycle is raised otherwise.
 
     Args:
-        successors_per_stop (dict): set of successors per stop.
+        successors_per_stop (dict or StopGraph): set of successors per stop or graph of the stops.
 
     Returns:
         (dict) sort index per stop.
     """
+    stop_graph = _as_stop_graph(successors_per_stop)
+    stops = stop_graph.stops
+    successor_offsets, successor_targets = stop_graph.successor_offsets, stop_graph.successor_targets
+    predecessor_offsets = stop_graph.predecessor_offsets
+
+    # init
+    nb_unsorted_predecessors = array("l", [predecessor_offsets[ind + 1] - predecessor_offsets[ind]
+                                           for ind in range(len(stops))])
+    stop_ids_to_sort = [ind for ind in reversed(range(len(stops))) if nb_unsorted_predecessors[ind] == 0]
+
+    # main loop
+    sorted_stop_ids = array("l")
+    while stop_ids_to_sort:
+        stop_id = stop_ids_to_sort.pop()
+        sorted_stop_ids.append(stop_id)
+        ready_stop_ids = []
+        for next_stop_id in successor_targets[successor_offsets[stop_id]:successor_offsets[stop_id + 1]]:
+            nb_unsorted_predecessors[next_stop_id] -= 1
+            if nb_unsorted_predecessors[next_stop_id] == 0:
+                ready_stop_ids.append(next_stop_id)
+        stop_ids_to_sort.extend(reversed(ready_stop_ids))
 
-    predecessors_per_stop = {s: set() for s in successors_per_stop}
-    for s, sucs in successors_per_stop.iteritems():
-        for suc in sucs:
-            preds_so_far = predecessors_per_stop.get(suc, set())
-            preds_so_far.add(s)
-            predecessors_per_stop[suc] = preds_so_far
+    if len(sorted_stop_ids) < len(stops):
+        raise CycleError(_find_cycle(stop_graph, nb_unsorted_predecessors))
+    return {stops[stop_id]: ind + 1 for ind, stop_id in enumerate(sorted_stop_ids)}
 
-    stops_without_predecessors = {s for (s, preds) in predecessors_per_stop.iteritems() if len(preds) == 0}
 
-    print "stops without predecessors: {}".format(stops_without_predecessors)
+def linearize_network(successors_per_stop, processes=1):
+    """
+    Sorts the stops of a whole network, which may be disconnected and contain cycles, in a linear order.
 
-    all_stops = successors_per_stop.keys()
+    The weakly connected components are sorted separately, on a pool of worker processes if processes is not 1.
+    Within each strongly connected component, the stops are ordered by the greedy heuristic of Eades, Lin and Smyth
+    and the edges going backwards in this order are ignored, such that the remaining graph is acyclic.
 
-    # assure that there are no direct loops; we do not assure that there are no loops at all!
-    for _stop in all_stops:
-        if _stop in predecessors_per_stop.keys() and _stop in successors_per_stop.keys():
-            intersection = set.intersection(predecessors_per_stop[_stop], successors_per_stop[_stop])
-            assert not intersection
+    Args:
+        successors_per_stop (dict or StopGraph): set of successors per stop or graph of the stops.
+        processes (int): number of worker processes, by default 1, None for the number of CPUs.
 
-    # init
+    Returns:
+        (tuple) sort index per stop, starting with 1 in each component, and component id (1, 2, ...) per stop.
+    """
+    stop_graph = _as_stop_graph(successors_per_stop)
+    component_per_stop_id = _get_weakly_connected_component_ids(stop_graph)
+    tasks = _split_into_components(stop_graph, component_per_stop_id)
+    if processes == 1:
+        sort_index_per_stop_per_component = [_linearize_component(task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            sort_index_per_stop_per_component = pool.map(_linearize_component, tasks)
+        finally:
+            pool.close()
+            pool.join()
     sort_index_per_stop = {}
-    queue = deque(stops_without_predecessors)
+    for component_sort_index_per_stop in sort_index_per_stop_per_component:
+        sort_index_per_stop.update(component_sort_index_per_stop)
+    return sort_index_per_stop, {stop_graph.stops[ind]: component for ind, component in enumerate(
+        component_per_stop_id)}
 
-    # main loop
-    def process_stop(stop, ind):
-        all_predecessors_marked = True
-        for before_stop in predecessors_per_stop.get(stop, []):
-            if before_stop not in sort_index_per_stop.keys():
-                all_predecessors_marked = False
-                break
-        if all_predecessors_marked:
-            if stop not in sort_index_per_stop.keys():
-                sort_index_per_stop[stop] = ind
-                ind += 1
-            for next_stop in successors_per_stop.get(stop, []):
-                ind = process_stop(next_stop, ind)
+
+def _linearize_component(stop_graph):
+    return linearize_stops_in_multiple_routes(remove_feedback_edges(stop_graph)[0])
+
+
+def _as_stop_graph(successors_per_stop):
+    if isinstance(successors_per_stop, StopGraph):
+        return successors_per_stop
+    return StopGraph.from_successors_per_stop(successors_per_stop)
+
+
+def _split_into_components(stop_graph, component_per_stop_id):
+    """Splits the graph into one graph per component (1, 2, ...), keeping the order of the stop ids."""
+    nb_components = max(component_per_stop_id) if component_per_stop_id else 0
+    stops_per_component = [[] for _ in range(nb_components)]
+    local_id_per_stop_id = array("l", [0]) * len(component_per_stop_id)
+    for stop_id, component in enumerate(component_per_stop_id):
+        local_id_per_stop_id[stop_id] = len(stops_per_component[component - 1])
+        stops_per_component[component - 1].append(stop_graph.stops[stop_id])
+    edge_sources_per_component = [array("i") for _ in range(nb_components)]
+    edge_targets_per_component = [array("i") for _ in range(nb_components)]
+    successor_offsets, successor_targets = stop_graph.successor_offsets, stop_graph.successor_targets
+    for stop_id, component in enumerate(component_per_stop_id):
+        edge_sources = edge_sources_per_component[component - 1]
+        edge_targets = edge_targets_per_component[component - 1]
+        for suc_id in successor_targets[successor_offsets[stop_id]:successor_offsets[stop_id + 1]]:
+            edge_sources.append(local_id_per_stop_id[stop_id])
+            edge_targets.append(local_id_per_stop_id[suc_id])
+    return [StopGraph(stops, edge_sources, edge_targets) for stops, edge_sources, edge_targets in zip(
+        stops_per_component, edge_sources_per_component, edge_targets_per_component)]
+
+
+def get_weakly_connected_components(successors_per_stop):
+    """Returns the component id per stop, numbered in the order of the smallest stop id of the components."""
+    stop_graph = _as_stop_graph(successors_per_stop)
+    return {stop_graph.stops[ind]: component for ind, component in enumerate(
+        _get_weakly_connected_component_ids(stop_graph))}
+
+
+def _get_weakly_connected_component_ids(stop_graph):
+    """Returns the component id (1, 2, ...) per stop id."""
+    component_per_stop_id = array("l", [0]) * stop_graph.get_nb_stops()
+    component = 0
+    for start_id in range(stop_graph.get_nb_stops()):
+        if component_per_stop_id[start_id]:
+            continue
+        component += 1
+        component_per_stop_id[start_id] = component
+        stop_ids_to_visit = [start_id]
+        while stop_ids_to_visit:
+            stop_id = stop_ids_to_visit.pop()
+            for neighbour_id in chain(stop_graph.get_successor_ids(stop_id), stop_graph.get_predecessor_ids(stop_id)):
+                if not component_per_stop_id[neighbour_id]:
+                    component_per_stop_id[neighbour_id] = component
+                    stop_ids_to_visit.append(neighbour_id)
+    return component_per_stop_id
+
+
+def get_strongly_connected_components(successors_per_stop):
+    """Returns the strongly connected components as lists of stops (iterative version of Tarjan's algorithm)."""
+    stop_graph = _as_stop_graph(successors_per_stop)
+    return [[stop_graph.stops[ind] for ind in component] for component in _get_strongly_connected_component_ids(
+        stop_graph)]
+
+
+def _get_strongly_connected_component_ids(stop_graph):
+    """Returns the strongly connected components as lists of stop ids, visiting the stops in the order of the ids."""
+    nb_stops = stop_graph.get_nb_stops()
+    successor_offsets, successor_targets = stop_graph.successor_offsets, stop_graph.successor_targets
+    index_per_stop_id = array("l", [-1]) * nb_stops
+    low_link_per_stop_id = array("l", [0]) * nb_stops
+    on_stack = bytearray(nb_stops)
+    stack = []
+    components = []
+    next_index = 0
+    for start_id in range(nb_stops):
+        if index_per_stop_id[start_id] >= 0:
+            continue
+        index_per_stop_id[start_id] = low_link_per_stop_id[start_id] = next_index
+        next_index += 1
+        stack.append(start_id)
+        on_stack[start_id] = 1
+        # per visited stop: its id and the position of its next successor in successor_targets
+        work = [[start_id, successor_offsets[start_id]]]
+        while work:
+            stop_id, position = work[-1]
+            if position == successor_offsets[stop_id + 1]:
+                work.pop()
+                if work:
+                    parent_id = work[-1][0]
+                    low_link_per_stop_id[parent_id] = min(low_link_per_stop_id[parent_id],
+                                                          low_link_per_stop_id[stop_id])
+                if low_link_per_stop_id[stop_id] == index_per_stop_id[stop_id]:
+                    component = []
+                    while True:
+                        component_stop_id = stack.pop()
+                        on_stack[component_stop_id] = 0
+                        component.append(component_stop_id)
+                        if component_stop_id == stop_id:
+                            break
+                    components.append(component)
+                continue
+            work[-1][1] = position + 1
+            next_id = successor_targets[position]
+            if index_per_stop_id[next_id] < 0:
+                index_per_stop_id[next_id] = low_link_per_stop_id[next_id] = next_index
+                next_index += 1
+                stack.append(next_id)
+                on_stack[next_id] = 1
+                work.append([next_id, successor_offsets[next_id]])
+            elif on_stack[next_id]:
+                low_link_per_stop_id[stop_id] = min(low_link_per_stop_id[stop_id], index_per_stop_id[next_id])
+    return components
+
+
+def remove_feedback_edges(successors_per_stop):
+    """
+    Removes edges such that the graph becomes acyclic.
+
+    Only edges within strongly connected components are removed: the stops of each component are ordered by the
+    greedy heuristic of Eades, Lin and Smyth, which keeps the number of edges going backwards small, and these edges
+    are removed.
+
+    Args:
+        successors_per_stop (dict or StopGraph): set of successors per stop or graph of the stops.
+
+    Returns:
+        (tuple) acyclic set of successors per stop, or acyclic graph if a graph is given, and list of removed edges.
+    """
+    stop_graph = _as_stop_graph(successors_per_stop)
+    stops = stop_graph.stops
+    component_per_stop_id = array("l", [-1]) * stop_graph.get_nb_stops()
+    position_per_stop_id = array("l", [0]) * stop_graph.get_nb_stops()
+    for component, component_stop_ids in enumerate(_get_strongly_connected_component_ids(stop_graph)):
+        for stop_id in component_stop_ids:
+            component_per_stop_id[stop_id] = component
+        if len(component_stop_ids) > 1:
+            for position, stop_id in enumerate(_get_greedy_feedback_order(component_stop_ids, stop_graph,
+                                                                          component_per_stop_id)):
+                position_per_stop_id[stop_id] = position
+
+    # an edge within a component is removed if it does not go forward in the order, which includes loops
+    edge_sources, edge_targets = array("i"), array("i")
+    removed_edges = []
+    successor_offsets, successor_targets = stop_graph.successor_offsets, stop_graph.successor_targets
+    for stop_id in range(stop_graph.get_nb_stops()):
+        for suc_id in successor_targets[successor_offsets[stop_id]:successor_offsets[stop_id + 1]]:
+            if component_per_stop_id[suc_id] == component_per_stop_id[stop_id] and \
+                    position_per_stop_id[suc_id] <= position_per_stop_id[stop_id]:
+                removed_edges.append((stops[stop_id], stops[suc_id]))
+            else:
+                edge_sources.append(stop_id)
+                edge_targets.append(suc_id)
+    if isinstance(successors_per_stop, StopGraph):
+        return StopGraph(stops, edge_sources, edge_targets), removed_edges
+    acyclic_successors_per_stop = {stop: set(sucs) for stop, sucs in successors_per_stop.iteritems()}
+    for stop, suc in removed_edges:
+        acyclic_successors_per_stop[stop].remove(suc)
+    return acyclic_successors_per_stop, removed_edges
+
+
+def _get_greedy_feedback_order(component_stop_ids, stop_graph, component_per_stop_id):
+    """Orders the stops by repeatedly taking sinks to the end, sources to the front or else max outdegree - indegree."""
+    component = component_per_stop_id[component_stop_ids[0]]
+    successors_in_component = {s: [suc for suc in stop_graph.get_successor_ids(s)
+                                   if suc != s and component_per_stop_id[suc] == component]
+                               for s in component_stop_ids}
+    predecessors_in_component = {s: [pred for pred in stop_graph.get_predecessor_ids(s)
+                                     if pred != s and component_per_stop_id[pred] == component]
+                                 for s in component_stop_ids}
+    out_degree = {s: len(sucs) for s, sucs in successors_in_component.iteritems()}
+    in_degree = {s: len(preds) for s, preds in predecessors_in_component.iteritems()}
+    sorted_stops = sorted(component_stop_ids, reverse=True)
+    sinks = [s for s in sorted_stops if out_degree[s] == 0]
+    sources = [s for s in sorted_stops if in_degree[s] == 0]
+    heap = [(in_degree[s] - out_degree[s], s) for s in component_stop_ids]
+    heapq.heapify(heap)
+    removed_stops = set()
+    front, back = [], []
+    while len(removed_stops) < len(component_stop_ids):
+        if sinks:
+            stop = sinks.pop()
+            if stop in removed_stops:
+                continue
+            back.append(stop)
+        elif sources:
+            stop = sources.pop()
+            if stop in removed_stops:
+                continue
+            front.append(stop)
         else:
-            if queue:
-                return process_stop(queue.popleft(), ind)
-        return ind
+            delta, stop = heapq.heappop(heap)
+            if stop in removed_stops or delta != in_degree[stop] - out_degree[stop]:
+                continue
+            front.append(stop)
+        removed_stops.add(stop)
+        for suc in successors_in_component[stop]:
+            if suc in removed_stops:
+                continue
+            in_degree[suc] -= 1
+            heapq.heappush(heap, (in_degree[suc] - out_degree[suc], suc))
+            if in_degree[suc] == 0:
+                sources.append(suc)
+        for pred in predecessors_in_component[stop]:
+            if pred in removed_stops:
+                continue
+            out_degree[pred] -= 1
+            heapq.heappush(heap, (in_degree[pred] - out_degree[pred], pred))
+            if out_degree[pred] == 0:
+                sinks.append(pred)
+    return front + list(reversed(back))
+
+
+def get_linear_order_cost(successors_per_stop, sort_index_per_stop):
+    """
+    Cost of a linear order: the sum of the lengths of the edges, where edges going backwards count
+    BACKWARD_EDGE_PENALTY times their length. It is small if the stops of the routes are close to each other.
+    """
+    if isinstance(successors_per_stop, StopGraph):
+        successors_per_stop = successors_per_stop.to_successors_per_stop()
+    return sum(_get_edge_cost(sort_index_per_stop[stop], sort_index_per_stop[suc])
+               for stop, sucs in successors_per_stop.iteritems() for suc in sucs)
+
+
+def improve_linear_order(successors_per_stop, sort_index_per_stop, time_budget=1.0, max_move=100):
+    """
+    Improves a linear order of the stops by local search, such that the routes stay as contiguous as possible.
+
+    Each stop is sifted through the order: it is moved step by step to the left and to the right by at most max_move
+    positions and put at the position with the lowest cost (see get_linear_order_cost). A stop is never moved past
+    its predecessor or successor, so no edge is turned backwards. The cost of each step is updated from the edges of
+    the two swapped stops only. The search ends when a pass over all stops brings no improvement or after time_budget
+    seconds.
+
+    Args:
+        successors_per_stop (dict or StopGraph): set of successors per stop or graph of the stops.
+        sort_index_per_stop (dict): initial sort index per stop, for example by linearize_stops_in_multiple_routes.
+        time_budget (float): maximal running time in seconds.
+        max_move (int): maximal number of positions a stop is moved in one step of the search.
+
+    Returns:
+        (dict) sort index per stop.
+    """
+    deadline = time.time() + time_budget
+    stop_graph = _as_stop_graph(successors_per_stop)
+    stops, id_per_stop = stop_graph.stops, stop_graph.id_per_stop
+    order = array("l", sorted((id_per_stop[stop] for stop in sort_index_per_stop),
+                              key=lambda ind: sort_index_per_stop[stops[ind]]))
+    position_per_stop_id = array("l", [0]) * stop_graph.get_nb_stops()
+    for position, stop_id in enumerate(order):
+        position_per_stop_id[stop_id] = position
+    improved = True
+    while improved and time.time() < deadline:
+        improved = False
+        for stop_id in array("l", order):
+            if time.time() >= deadline:
+                break
+            start_position = position_per_stop_id[stop_id]
+            best_delta, best_position = 0, start_position
+            for direction in [-1, 1]:
+                delta = 0
+                while abs(position_per_stop_id[stop_id] - start_position) < max_move:
+                    left_position = position_per_stop_id[stop_id] + min(direction, 0)
+                    if not 0 <= left_position < len(order) - 1 or \
+                            _has_edge(stop_graph, order[left_position], order[left_position + 1]):
+                        break
+                    delta += _get_swap_delta(left_position, order, position_per_stop_id, stop_graph)
+                    _swap(left_position, order, position_per_stop_id)
+                    if delta < best_delta:
+                        best_delta, best_position = delta, position_per_stop_id[stop_id]
+                _move(stop_id, start_position, order, position_per_stop_id)
+            if best_delta < 0:
+                _move(stop_id, best_position, order, position_per_stop_id)
+                improved = True
+    return {stops[stop_id]: position + 1 for position, stop_id in enumerate(order)}
+
+
+def _has_edge(stop_graph, stop_id, suc_id):
+    """Whether the edge exists, by binary search in the sorted successors of the stop."""
+    end = stop_graph.successor_offsets[stop_id + 1]
+    position = bisect_left(stop_graph.successor_targets, suc_id, stop_graph.successor_offsets[stop_id], end)
+    return position < end and stop_graph.successor_targets[position] == suc_id
+
+
+def _get_edge_cost(position_from, position_to):
+    if position_to > position_from:
+        return position_to - position_from
+    return BACKWARD_EDGE_PENALTY * (position_from - position_to)
+
+
+def _get_swap_delta(left_position, order, position_per_stop_id, stop_graph):
+    """Change of the cost if the stops at left_position and left_position + 1 are swapped."""
+    successor_offsets, successor_targets = stop_graph.successor_offsets, stop_graph.successor_targets
+    predecessor_offsets, predecessor_targets = stop_graph.predecessor_offsets, stop_graph.predecessor_targets
+    left_id, right_id = order[left_position], order[left_position + 1]
+    delta = 0
+    for stop_id, position, new_position, other_id in [(left_id, left_position, left_position + 1, right_id),
+                                                      (right_id, left_position + 1, left_position, left_id)]:
+        for suc_id in successor_targets[successor_offsets[stop_id]:successor_offsets[stop_id + 1]]:
+            if suc_id != other_id:
+                suc_position = position_per_stop_id[suc_id]
+                delta += _get_edge_cost(new_position, suc_position) - _get_edge_cost(position, suc_position)
+            elif stop_id == left_id:
+                delta += _get_edge_cost(left_position + 1, left_position) - _get_edge_cost(left_position,
+                                                                                           left_position + 1)
+        for pred_id in predecessor_targets[predecessor_offsets[stop_id]:predecessor_offsets[stop_id + 1]]:
+            if pred_id != other_id:
+                pred_position = position_per_stop_id[pred_id]
+                delta += _get_edge_cost(pred_position, new_position) - _get_edge_cost(pred_position, position)
+            elif stop_id == left_id:
+                delta += _get_edge_cost(left_position, left_position + 1) - _get_edge_cost(left_position + 1,
+                                                                                           left_position)
+    return delta
 
-    # start process
-    process_stop(queue.popleft(), 1)
-    for x in sorted([(nr, _stop) for _stop, nr in sort_index_per_stop.iteritems()]):
-        print "{}, predecessor: {}, successor: {}".format(x, list(predecessors_per_stop.get(x[1], [])),
-                                                          list(successors_per_stop.get(x[1], [])))
-    assert len(sort_index_per_stop) == len(all_stops)
-    return sort_index_per_stop
+
+def _swap(left_position, order, position_per_stop):
+    left_stop, right_stop = order[left_position], order[left_position + 1]
+    order[left_position], order[left_position + 1] = right_stop, left_stop
+    position_per_stop[left_stop], position_per_stop[right_stop] = left_position + 1, left_position
+
+
+def _move(stop, position, order, position_per_stop):
+    while position_per_stop[stop] < position:
+        _swap(position_per_stop[stop], order, position_per_stop)
+    while position_per_stop[stop] > position:
+        _swap(position_per_stop[stop] - 1, order, position_per_stop)
+
+
+def _find_cycle(stop_graph, nb_unsorted_predecessors):
+    """Finds a cycle among the unsorted stops, each of which has an unsorted predecessor."""
+    stop_id = min(ind for ind, nb in enumerate(nb_unsorted_predecessors) if nb > 0)
+    position_per_stop_id = {}
+    path = []
+    while stop_id not in position_per_stop_id:
+        position_per_stop_id[stop_id] = len(path)
+        path.append(stop_id)
+        stop_id = min(pred for pred in stop_graph.get_predecessor_ids(stop_id) if nb_unsorted_predecessors[pred] > 0)
+    cycle = [stop_graph.stops[ind] for ind in reversed(path[position_per_stop_id[stop_id]:])]
+    first_position = cycle.index(min(cycle))
+    return cycle[first_position:] + cycle[:first_position]
+
+
+def get_stop_graph_from_file(path_in):
+    """Extracts the graph of the stops from a file like in get_successors_per_stop_from_file."""
+    # Columns:
+    # "Id": id of the route.
+    # "Richtung": direction of the route (used to decide in which order stops should be interpreted.
+    # "Name": name of the stop
+    # the rows of a route need not be consecutive, so its blocks of rows are joined before the direction is applied
+    stops_per_route = OrderedDict()
+    for route, stops in iter_routes(path_in, ["Id", "Richtung"], "Name"):
+        stops_per_route.setdefault(route, []).extend(stops)
+    stop_graph = StopGraph.from_routes(reversed(stops) if direction == "R" else stops
+                                       for (route_id, direction), stops in stops_per_route.items())
+    instrumentation.count("stops", stop_graph.get_nb_stops())
+    instrumentation.count("edges", stop_graph.get_nb_edges())
+    return stop_graph
 
 
 def get_successors_per_stop_from_file(path_in):
     """Extracts the data from a file, which can be produce for example by the timeprofileitem list in Visum."""
-    list_per_id = defaultdict(list)
-    with open(path_in) as f:
-        reader = csv.DictReader(f, delimiter=";")
-        for row in reader:
-            # Columns:
-            # "Id": id of the route.
-            # "Richtung": direction of the route (used to decide in which order stops should be interpreted.
-            # "Name": name of the stop
-            list_per_id[row["Id"], row["Richtung"]] += [row["Name"]]
-    for route_id, direction in list_per_id.keys():
-        if direction == "R":
-            list_per_id[(route_id, direction)] = list(reversed(list_per_id[(route_id, direction)]))
-    all_stops = set()
-    for a_list in list_per_id.values():
-        all_stops = all_stops.union(set(a_list))
-    print "nb stops: {}".format(len(all_stops))
-    successors_list = {s: [] for s in all_stops}
-    for a_list in list_per_id.values():
-        for i in range(len(a_list)):
-            now = a_list[i]
-            after = a_list[i + 1] if i < len(a_list) - 1 else None
-            if after:
-                successors_list[now] += [after]
-    successors_per_stop = defaultdict(set, {s: set(l) for s, l in successors_list.iteritems()})
-    return successors_per_stop
+    return defaultdict(set, get_stop_graph_from_file(path_in).to_successors_per_stop())
 
 
-if __name__ == "__main__":
+def main(args):
+    parser = argparse.ArgumentParser(description="Sorts the stops of the routes in a file in a linear order.")
+    parser.add_argument("path_in", help="file with the columns Id, Richtung and Name per route item")
+    parser.add_argument("path_out", help="path of the lines 'index_sorted;stop'")
+    parser.add_argument("--profile", help="path of a JSON report with the time and memory per stage")
+    parser.add_argument("--cache-dir", help="directory of a persistent cache of the results per input")
+    options = parser.parse_args(args)
+    instrumentation.enable(options.profile is not None)
+    result_cache = ResultCache(options.cache_dir) if options.cache_dir else None
 
-    _path_in = sys.argv[1]
-    _path_out = sys.argv[2]
+    with instrumentation.timer("parse"):
+        stop_graph = get_stop_graph_from_file(options.path_in)
+    with instrumentation.timer("sort"):
+        sort_index_per_stop = call_cached(result_cache, linearize_stops_in_multiple_routes, stop_graph)
+    with instrumentation.timer("write"):
+        with open(options.path_out, "wb") as f:
+            instrumentation.write_rows(f, [("index_sorted", "stop")])
+            instrumentation.write_rows(f, sorted(((ind, stop) for stop, ind in sort_index_per_stop.iteritems())))
+    if result_cache is not None:
+        sys.stderr.write(result_cache.get_summary() + "\n")
+    if options.profile:
+        instrumentation.get_instrumentation().write_report(options.profile)
+    return 0
 
-    _sort_index_per_stop = linearize_stops_in_multiple_routes(get_successors_per_stop_from_file(_path_in))
 
-    with open(_path_out, "wb") as _f:
-        writer = csv.writer(_f, delimiter=";")
-        writer.writerow(["index_sorted", "stop"])
-        for k, v in sorted(_sort_index_per_stop.iteritems(), key=lambda x: x[1]):
-            writer.writerow([v, k])
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,96 @@
+from array import array
+
+"""A compact directed graph of stops in compressed sparse row format."""
+
+
+class StopGraph(object):
+    """
+    Directed graph of stops, where the stops are numbered 0, ..., n - 1.
+
+    The successors of the stop with id i are successor_targets[successor_offsets[i]:successor_offsets[i + 1]],
+    sorted by id and without duplicates, and the predecessors are stored analogously. Each edge thus takes two
+    integers in the arrays instead of entries in a dict of sets.
+    """
+
+    def __init__(self, stops, edge_sources, edge_targets):
+        """
+        Args:
+            stops (list): stop per id.
+            edge_sources (array): id of the source stop per edge, duplicate edges are allowed.
+            edge_targets (array): id of the target stop per edge.
+        """
+        self.stops = stops
+        self.id_per_stop = {stop: ind for ind, stop in enumerate(stops)}
+        self.successor_offsets, self.successor_targets = _build_compressed_rows(len(stops), edge_sources,
+                                                                                edge_targets)
+        self.predecessor_offsets, self.predecessor_targets = _build_compressed_rows(len(stops), edge_targets,
+                                                                                    edge_sources)
+
+    @classmethod
+    def from_routes(cls, routes):
+        """Creates the graph with an edge from each stop of a route to the next one. The ids follow the routes."""
+        id_per_stop = {}
+        edge_sources = array("i")
+        edge_targets = array("i")
+        for route in routes:
+            previous_stop_id = None
+            for stop in route:
+                stop_id = id_per_stop.setdefault(stop, len(id_per_stop))
+                if previous_stop_id is not None:
+                    edge_sources.append(previous_stop_id)
+                    edge_targets.append(stop_id)
+                previous_stop_id = stop_id
+        stops = [None] * len(id_per_stop)
+        for stop, stop_id in id_per_stop.items():
+            stops[stop_id] = stop
+        return cls(stops, edge_sources, edge_targets)
+
+    @classmethod
+    def from_successors_per_stop(cls, successors_per_stop):
+        """Creates the graph from a set of successors per stop. The ids follow the sorted stops."""
+        stops = sorted(set(successors_per_stop).union(*successors_per_stop.values()))
+        id_per_stop = {stop: ind for ind, stop in enumerate(stops)}
+        edge_sources = array("i")
+        edge_targets = array("i")
+        for stop, successors in successors_per_stop.items():
+            for successor in successors:
+                edge_sources.append(id_per_stop[stop])
+                edge_targets.append(id_per_stop[successor])
+        return cls(stops, edge_sources, edge_targets)
+
+    def get_nb_stops(self):
+        return len(self.stops)
+
+    def get_nb_edges(self):
+        return len(self.successor_targets)
+
+    def get_successor_ids(self, stop_id):
+        return self.successor_targets[self.successor_offsets[stop_id]:self.successor_offsets[stop_id + 1]]
+
+    def get_predecessor_ids(self, stop_id):
+        return self.predecessor_targets[self.predecessor_offsets[stop_id]:self.predecessor_offsets[stop_id + 1]]
+
+    def to_successors_per_stop(self):
+        """Returns the set of successors per stop."""
+        return {stop: {self.stops[suc] for suc in self.get_successor_ids(ind)}
+                for ind, stop in enumerate(self.stops)}
+
+
+def _build_compressed_rows(nb_rows, row_ids, column_ids):
+    """Sorts the entries (row id, column id) by row into offsets and sorted, unique column ids per row."""
+    counts = array("l", [0]) * (nb_rows + 1)
+    for row_id in row_ids:
+        counts[row_id + 1] += 1
+    for ind in range(nb_rows):
+        counts[ind + 1] += counts[ind]
+    next_positions = array("l", counts)
+    columns = array("i", [0]) * len(column_ids)
+    for ind, row_id in enumerate(row_ids):
+        columns[next_positions[row_id]] = column_ids[ind]
+        next_positions[row_id] += 1
+    offsets = array("l", [0])
+    unique_columns = array("i")
+    for ind in range(nb_rows):
+        unique_columns.extend(sorted(set(columns[counts[ind]:counts[ind + 1]])))
+        offsets.append(len(unique_columns))
+    return offsets, unique_columns
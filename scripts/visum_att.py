@@ -0,0 +1,63 @@
+import csv
+import gzip
+from itertools import groupby
+
+"""A streaming reader for Visum attribute files (.att) and similar semicolon separated files."""
+
+GZIP_MAGIC_NUMBER = b"\x1f\x8b"
+
+
+def open_att_file(path):
+    """Opens a plain or a gzip compressed file for reading."""
+    with open(path, "rb") as f:
+        is_gzip = f.read(2) == GZIP_MAGIC_NUMBER
+    return gzip.open(path, "rb") if is_gzip else open(path, "rb")
+
+
+def iter_rows(path, columns, delimiter=";"):
+    """
+    Yields the values of the given columns per data row.
+
+    The header is the first line containing all the columns. In Visum files it is the line of a table starting with
+    "$<TABLE>:", whose prefix is ignored. The rows end at the next table, lines starting with "*" are comments.
+
+    Args:
+        path (str): path to the file, which may be gzip compressed.
+        columns (list): names of the columns to read.
+        delimiter (str): delimiter of the columns.
+
+    Returns:
+        (generator) tuple of values per row.
+    """
+    with open_att_file(path) as f:
+        reader = csv.reader(f, delimiter=delimiter)
+        indices = None
+        for row in reader:
+            if not row or row[0].startswith("*"):
+                continue
+            if indices is None:
+                header = [row[0].split(":", 1)[-1] if row[0].startswith("$") else row[0]] + row[1:]
+                if all(column in header for column in columns):
+                    indices = [header.index(column) for column in columns]
+                continue
+            if row[0].startswith("$"):
+                break
+            yield tuple(row[ind] for ind in indices)
+        if indices is None:
+            raise ValueError("no header with columns {} in {}".format(columns, path))
+
+
+def iter_routes(path, route_key_columns, stop_column, delimiter=";"):
+    """
+    Yields the stops of the routes in a file with one row per route item.
+
+    Consecutive rows with the same values in the route key columns form a route. A route whose rows are not
+    consecutive is yielded once per block of rows.
+
+    Returns:
+        (generator) pairs (tuple of route key values, tuple of stops).
+    """
+    nb_key_columns = len(route_key_columns)
+    rows = iter_rows(path, list(route_key_columns) + [stop_column], delimiter=delimiter)
+    for route_key, route_rows in groupby(rows, key=lambda row: row[:nb_key_columns]):
+        yield route_key, tuple(row[nb_key_columns] for row in route_rows)
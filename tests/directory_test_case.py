@@ -0,0 +1,22 @@
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class DirectoryTestCase(unittest.TestCase):
+    """Test case with a temporary directory per test, which is removed after the test."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_file(self, name, content, compress=False):
+        """Writes the content to a file in the directory, gzip compressed if compress, and returns its path."""
+        path = os.path.join(self.directory, name)
+        with (gzip.open(path, "wb") if compress else open(path, "wb")) as f:
+            f.write(content)
+        return path
@@ -0,0 +1,37 @@
+import unittest
+
+from benchmarks.generators import generate_stop_network, generate_timetable, generate_tripintripout_matrix
+from benchmarks.run_benchmarks import add_growth_exponents, compare_with_baseline
+from scripts.route_linearization import linearize_stops_in_multiple_routes
+
+
+class BenchmarksTest(unittest.TestCase):
+    def test_generate_tripintripout_matrix(self):
+        tripintripout_matrix, calibration_volumes = generate_tripintripout_matrix(10, seed=1)
+        self.assertEqual(9, len(calibration_volumes))
+        self.assertEqual(tripintripout_matrix, generate_tripintripout_matrix(10, seed=1)[0])
+
+    def test_generate_timetable(self):
+        route_per_id = generate_timetable(50, 200, route_length=10, seed=1)
+        self.assertEqual(50, len(route_per_id))
+        for route in route_per_id.values():
+            self.assertEqual(10, len(set(route)))
+        self.assertEqual(route_per_id, generate_timetable(50, 200, route_length=10, seed=1))
+
+    def test_generate_stop_network(self):
+        successors_per_stop = generate_stop_network(100, 250, seed=1)
+        self.assertEqual(250, sum(len(sucs) for sucs in successors_per_stop.values()))
+        self.assertEqual(100, len(linearize_stops_in_multiple_routes(successors_per_stop)))
+
+    def test_compare_with_baseline(self):
+        results = add_growth_exponents([{"benchmark": "a", "size": 10, "seconds": 1.0},
+                                        {"benchmark": "a", "size": 20, "seconds": 4.0}])
+        self.assertAlmostEqual(2.0, results[1]["growth_exponent"])
+        regressions = compare_with_baseline(results, [{"benchmark": "a", "size": 10, "seconds": 0.5},
+                                                      {"benchmark": "a", "size": 20, "seconds": 3.5}], 1.5)
+        self.assertEqual(1, len(regressions))
+        self.assertAlmostEqual(2.0, results[0]["ratio_to_baseline"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,18 @@
+import ctypes
+import os
+import shutil
+import tempfile
 import unittest
 
-from scripts.inoutcalibration import TripInTripOutMatrix, create_alpha, create_beta, get_beta_basis, \
-    get_orthonormal_basis_of_normal_space, get_trivial_solution
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from scripts.inoutcalibration import Calibrator, SparseTripInTripOutMatrix, TripInTripOutMatrix, calibrate_batch, \
+    calibrate_packed, calibrate_parallel, create_alpha, create_beta, get_beta_basis, get_components, \
+    get_normal_space_components, get_orthogonality_error, get_orthonormal_basis_of_normal_space, get_packed_index, \
+    get_packed_size, get_trivial_solution, gram_schmidt, iter_packed_keys, main, pack_upper_triangle
 
 
 class TripinTripOutCalibrationTest(unittest.TestCase):
@@ -12,6 +23,100 @@ class TripinTripOutCalibrationTest(unittest.TestCase):
         m_1[2, 3] = 5.0
         self.assertEqual(m_1.get_nonzero_entries(), {(1, 2), (2, 3)})
 
+    def test_dict_api(self):
+        for matrix_class in [TripInTripOutMatrix, SparseTripInTripOutMatrix]:
+            m_1 = matrix_class(3)
+            m_1[1, 2] = 1.0
+            m_1[2, 3] = 1e-14
+            self.assertEqual(2, len(m_1))
+            self.assertEqual([(1, 2), (2, 3)], list(m_1))
+            self.assertEqual([1.0, 1e-14], m_1.values())
+            self.assertTrue((1, 2) in m_1)
+            self.assertTrue((2, 3) in m_1)
+            self.assertFalse((1, 3) in m_1)
+            self.assertFalse((3, 2) in m_1)
+            self.assertFalse("a" in m_1)
+            self.assertEqual(1.0, m_1.get((1, 2)))
+            self.assertEqual(None, m_1.get((1, 3)))
+            self.assertEqual(-1.0, m_1.get((1, 3), -1.0))
+            self.assertEqual(None, m_1.get((4, 4)))
+
+    def test_nonzero_entries_with_tolerance(self):
+        m_1 = TripInTripOutMatrix(3)
+        m_1[1, 2] = 1.0
+        m_1[1, 3] = 1e-14
+        m_1[2, 3] = 1e-6
+        self.assertEqual({(1, 2), (2, 3)}, m_1.get_nonzero_entries())
+        self.assertEqual({(1, 2)}, m_1.get_nonzero_entries(tolerance=1e-3))
+        # the dict API keeps the entries within the tolerance until they are pruned
+        self.assertEqual([(1, 2), (1, 3), (2, 3)], list(m_1))
+        self.assertEqual(list(m_1), m_1.keys())
+        self.assertEqual(3, len(m_1.items()))
+        self.assertEqual(len(m_1), len(m_1.keys()))
+        self.assertTrue((1, 3) in m_1)
+        self.assertEqual(m_1, SparseTripInTripOutMatrix.from_matrix(m_1))
+        m_1.prune()
+        self.assertEqual([(1, 2), (2, 3)], m_1.keys())
+        self.assertEqual(0.0, m_1[1, 3])
+        for should_be, to_test in zip([1.0, 1e-6], m_1.get_section_volumes()):
+            self.assertAlmostEqual(should_be, to_test, places=15)
+
+        sparse_matrix = SparseTripInTripOutMatrix(3)
+        sparse_matrix[1, 2] = 0.1
+        sparse_matrix[2, 3] = 1.0
+        other = SparseTripInTripOutMatrix(3)
+        other[1, 2] = 0.1 / 3.0
+        other[2, 3] = 1.0
+        sparse_matrix.axpy(-3.0, other)
+        self.assertEqual({(2, 3)}, set(sparse_matrix._entries))
+
+    def test_packed_index(self):
+        dim = 5
+        keys = list(iter_packed_keys(dim))
+        self.assertEqual(get_packed_size(dim), len(keys))
+        for ind, (i, j) in enumerate(keys):
+            self.assertEqual(ind, get_packed_index(i, j, dim))
+
+    def test_invalid_keys(self):
+        m_1 = TripInTripOutMatrix(3)
+        with self.assertRaises(KeyError):
+            m_1[2, 1] = 1.0
+        with self.assertRaises(KeyError):
+            m_1[1, 4]
+        with self.assertRaises(ValueError):
+            m_1[1, 2] = "1.0"
+
+    def test_sparse_matrix(self):
+        dim = 4
+        sparse_matrix = SparseTripInTripOutMatrix(dim)
+        sparse_matrix[1, 2] = 2.0
+        sparse_matrix[2, 4] = 3.0
+        self.assertEqual(0.0, sparse_matrix[1, 3])
+        self.assertEqual({(1, 2), (2, 4)}, sparse_matrix.get_nonzero_entries())
+        sparse_matrix[1, 2] = 0.0
+        self.assertEqual({(2, 4)}, sparse_matrix.get_nonzero_entries())
+        with self.assertRaises(KeyError):
+            sparse_matrix[3, 2]
+
+        dense_matrix = TripInTripOutMatrix(dim)
+        dense_matrix[2, 4] = 2.0
+        dense_matrix[3, 4] = 1.0
+        self.assertEqual(dense_matrix, SparseTripInTripOutMatrix.from_matrix(dense_matrix))
+        self.assertEqual(6.0, sparse_matrix.scalar_product(dense_matrix))
+        self.assertEqual(6.0, dense_matrix.scalar_product(sparse_matrix))
+        self.assertEqual({(2, 4)}, (dense_matrix * sparse_matrix).get_nonzero_entries())
+        self.assertTrue(isinstance(dense_matrix * sparse_matrix, SparseTripInTripOutMatrix))
+        self.assertFalse(isinstance(sparse_matrix + dense_matrix, SparseTripInTripOutMatrix))
+        self.assertEqual(5.0, (sparse_matrix + dense_matrix)[2, 4])
+        self.assertEqual(-1.0, (dense_matrix - sparse_matrix)[2, 4])
+
+        difference = sparse_matrix - SparseTripInTripOutMatrix.from_matrix(sparse_matrix)
+        self.assertTrue(isinstance(difference, SparseTripInTripOutMatrix))
+        self.assertEqual(set(), difference.get_nonzero_entries())
+        self.assertEqual([0.0, 3.0, 3.0], sparse_matrix.get_section_volumes())
+        sparse_matrix[1, 4] = 1.0
+        self.assertEqual([1.0, 4.0, 4.0], sparse_matrix.get_section_volumes())
+
     def test_add(self):
         dim = 3
         m_1 = TripInTripOutMatrix(dim)
@@ -30,6 +135,45 @@ class TripinTripOutCalibrationTest(unittest.TestCase):
         to_test = m_1 + m_2
         self.assertEqual(m_add, to_test, msg="m_add:\n{}\nto_test:\n{}".format(m_add, to_test))
 
+    def test_inplace_operators(self):
+        for matrix_class in [TripInTripOutMatrix, SparseTripInTripOutMatrix]:
+            m_1 = matrix_class(3)
+            m_1[1, 2] = 1.0
+            m_1[2, 3] = 2.0
+            m_2 = SparseTripInTripOutMatrix(3)
+            m_2[1, 3] = 4.0
+            m_2[2, 3] = -2.0
+            m_3 = TripInTripOutMatrix(3)
+            m_3[1, 2] = 3.0
+            m_3[2, 3] = 1.0
+            self.assertEqual([3.0, 1.0], m_3.get_section_volumes())
+            should_be = m_1 + m_2
+            self.assertEqual([1.0, 2.0], m_1.get_section_volumes())
+            m_1_before = m_1
+            m_1 += m_2
+            self.assertTrue(m_1 is m_1_before)
+            self.assertEqual(should_be, m_1)
+            self.assertEqual({(1, 2), (1, 3)}, m_1.get_nonzero_entries())
+            self.assertEqual([5.0, 4.0], m_1.get_section_volumes())
+            m_1 -= m_3
+            self.assertEqual(-2.0, m_1[1, 2])
+            self.assertEqual(-1.0, m_1[2, 3])
+            m_1 *= 2
+            self.assertEqual([4.0, 6.0], m_1.get_section_volumes())
+            m_1 *= m_3
+            self.assertEqual({(1, 2), (2, 3)}, m_1.get_nonzero_entries())
+            self.assertEqual(-12.0, m_1[1, 2])
+            copy = m_1.copy().axpy(0.5, m_3)
+            self.assertEqual(-10.5, copy[1, 2])
+            self.assertEqual(-12.0, m_1[1, 2])
+            self.assertEqual(-12.0 * 3.0 - 2.0 * 1.0, m_1.dot(m_3))
+
+    def test_gram_schmidt_keeps_input(self):
+        betas = get_beta_basis(4)
+        self.assertEqual(betas, get_beta_basis(4))
+        gram_schmidt(betas)
+        self.assertEqual(betas, get_beta_basis(4))
+
     def test_mult(self):
         dim = 3
         m_1 = TripInTripOutMatrix(dim)
@@ -104,6 +248,45 @@ class TripinTripOutCalibrationTest(unittest.TestCase):
                 msg = "scalar-product of {}-th and {}-th matrix is {}, should be 0.0".format(i, j, to_test)
                 self.assertAlmostEqual(0.0, to_test, places=5, msg=msg)
 
+    def test_gram_schmidt_is_numerically_stable(self):
+        def classical_gram_schmidt(matrices):
+            new_matrices = []
+            for matrix in matrices:
+                act_matrix = matrix.copy()
+                for new_matrix in new_matrices:
+                    act_matrix.axpy(-new_matrix.dot(matrix), new_matrix)
+                act_matrix *= 1.0 / act_matrix.norm()
+                new_matrices += [act_matrix]
+            return new_matrices
+
+        # nearly collinear matrices, on which the classical process loses the orthogonality
+        dim = 4
+        keys = list(iter_packed_keys(dim))
+        matrices = []
+        for key in keys[:6]:
+            matrix = TripInTripOutMatrix(dim)
+            for other_key in keys:
+                matrix[other_key] = 1.0
+            matrix[key] += 1e-6
+            matrices.append(matrix)
+        self.assertGreater(get_orthogonality_error(classical_gram_schmidt(matrices)), 1e-4)
+        self.assertLess(get_orthogonality_error(gram_schmidt(matrices)), 1e-8)
+        self.assertLess(get_orthogonality_error(gram_schmidt(get_beta_basis(30))), 1e-10)
+
+    def test_orthonormal_basis_is_cached(self):
+        self.assertTrue(get_orthonormal_basis_of_normal_space(7)[3] is get_orthonormal_basis_of_normal_space(7)[3])
+
+    def test_normal_space_components(self):
+        dim = 6
+        tripintripout_matrix = TripInTripOutMatrix(dim)
+        for ind, (i, j) in enumerate(iter_packed_keys(dim)):
+            tripintripout_matrix[i, j] = (ind * 7 % 11) - 3.5
+        should_be_1, should_be_2 = get_components(tripintripout_matrix, get_orthonormal_basis_of_normal_space(dim))
+        to_test_1, to_test_2 = get_normal_space_components(tripintripout_matrix)
+        for i, j in iter_packed_keys(dim):
+            self.assertAlmostEqual(should_be_1[i, j], to_test_1[i, j], places=8)
+            self.assertAlmostEqual(should_be_2[i, j], to_test_2[i, j], places=8)
+
     def test_get_section_volumes(self):
         dim = 4
         tripintripout_matrix = TripInTripOutMatrix(dim)
@@ -119,6 +302,19 @@ class TripinTripOutCalibrationTest(unittest.TestCase):
             msg = "volumes on section {}. should be: {}. is: {}".format(i + 1, should_be[i], to_test[i])
             self.assertAlmostEqual(should_be[i], to_test[i], places=5, msg=msg)
 
+    def test_get_section_volumes_after_update(self):
+        dim = 4
+        tripintripout_matrix = TripInTripOutMatrix(dim)
+        tripintripout_matrix[1, 3] = 4
+        tripintripout_matrix[2, 4] = 7
+        self.assertEqual([4.0, 11.0, 7.0], tripintripout_matrix.get_section_volumes())
+        tripintripout_matrix[1, 3] = 1
+        tripintripout_matrix[3, 4] = 2
+        self.assertEqual([1.0, 8.0, 9.0], tripintripout_matrix.get_section_volumes())
+        self.assertEqual(8.0, tripintripout_matrix.get_section_volume(2))
+        with self.assertRaises(ValueError):
+            tripintripout_matrix.get_section_volume(4)
+
     def test_get_trivial_solution(self):
         dim = 4
         section_volumes = [3.0, 4.56, 6.78]
@@ -167,6 +363,186 @@ class TripinTripOutCalibrationTest(unittest.TestCase):
             msg = "calibrated volumes on section {} should equal {}, but is {}".format(i, should_be, to_test)
             self.assertAlmostEqual(should_be, to_test, places=5, msg=msg)
 
+    def test_calibrate_batch(self):
+        dim = 4
+        matrix_1 = TripInTripOutMatrix(dim)
+        matrix_1[1, 2] = 3
+        matrix_1[1, 4] = 5
+        matrix_1[2, 3] = 6
+        matrix_1[3, 4] = 8
+        matrix_2 = TripInTripOutMatrix(dim)
+        matrix_2[1, 3] = 2
+        matrix_2[2, 4] = 1
+        volumes_1 = [10.3, 25.5, 18.3]
+        volumes_2 = [1.0, 2.0, 1.5]
+        for matrices, volumes_list in [([matrix_1], [volumes_1, volumes_2]), ([matrix_1, matrix_2], [volumes_2]),
+                                       ([matrix_1, matrix_2], [volumes_1, volumes_2])]:
+            calibrated_matrices = calibrate_batch(matrices, volumes_list)
+            self.assertEqual(max(len(matrices), len(volumes_list)), len(calibrated_matrices))
+            for ind, calibrated_matrix in enumerate(calibrated_matrices):
+                matrix = matrices[ind if len(matrices) > 1 else 0]
+                volumes = volumes_list[ind if len(volumes_list) > 1 else 0]
+                should_be = matrix.calibrate(volumes)
+                for key in should_be.get_nonzero_entries().union(calibrated_matrix.get_nonzero_entries()):
+                    self.assertAlmostEqual(should_be[key], calibrated_matrix[key], places=8)
+                for should_be_volume, to_test in zip(volumes, calibrated_matrix.get_section_volumes()):
+                    self.assertAlmostEqual(should_be_volume, to_test, places=5)
+        with self.assertRaises(ValueError):
+            calibrate_batch([matrix_1, matrix_2], [volumes_1, volumes_2, volumes_1])
+
+    def test_calibrator(self):
+        dim = 5
+        tripintripout_matrix = TripInTripOutMatrix(dim)
+        for ind, (i, j) in enumerate(iter_packed_keys(dim)):
+            if i < j:
+                tripintripout_matrix[i, j] = ind % 4 + 1.0
+        calibration_volumes = [10.3, 25.5, 18.3, 7.0]
+        calibrator = Calibrator(tripintripout_matrix, calibration_volumes)
+        for volume_per_section in [{}, {1: 12.0}, {4: 3.5}, {2: 30.0, 3: 20.0}]:
+            calibrator.update_volumes(volume_per_section)
+            for k, volume in volume_per_section.items():
+                calibration_volumes[k - 1] = volume
+            self.assertEqual(calibration_volumes, calibrator.calibration_volumes)
+            should_be = tripintripout_matrix.calibrate(calibration_volumes)
+            calibrated_matrix = calibrator.get_calibrated_matrix()
+            for key in iter_packed_keys(dim):
+                self.assertAlmostEqual(should_be[key], calibrated_matrix[key], places=10)
+            for should_be_volume, to_test in zip(calibration_volumes, calibrated_matrix.get_section_volumes()):
+                self.assertAlmostEqual(should_be_volume, to_test, places=10)
+        with self.assertRaises(ValueError):
+            calibrator.update_volumes({5: 1.0})
+
+    def test_calibrate_packed(self):
+        dim = 4
+        tripintripout_matrix = TripInTripOutMatrix(dim)
+        rows = [[0.0] * dim for _ in range(dim)]
+        for ind, (i, j) in enumerate(iter_packed_keys(dim)):
+            tripintripout_matrix[i, j] = ind + 1.0
+            rows[i - 1][j - 1] = ind + 1.0
+        rows[3][0] = 99.0
+        values = pack_upper_triangle(rows)
+        calibration_volumes = [10.3, 25.5, 18.3]
+        calibrated_values, section_volumes = calibrate_packed(values, calibration_volumes)
+        should_be = tripintripout_matrix.calibrate(calibration_volumes)
+        for ind, key in enumerate(iter_packed_keys(dim)):
+            self.assertAlmostEqual(should_be[key], calibrated_values[ind], places=8)
+        for should_be_volume, to_test in zip(calibration_volumes, section_volumes):
+            self.assertAlmostEqual(should_be_volume, to_test, places=8)
+        self.assertEqual(values, pack_upper_triangle(rows))
+        with self.assertRaises(ValueError):
+            calibrate_packed(values[1:], calibration_volumes)
+
+    def test_save_and_load(self):
+        dim = 5
+        tripintripout_matrix = TripInTripOutMatrix(dim)
+        for ind, (i, j) in enumerate(iter_packed_keys(dim)):
+            tripintripout_matrix[i, j] = ind / 3.0
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "matrix.bin")
+            tripintripout_matrix.save(path)
+            self.assertEqual(16 + 8 * get_packed_size(dim), os.path.getsize(path))
+            loaded_matrix = TripInTripOutMatrix.load(path)
+            self.assertEqual(tripintripout_matrix, loaded_matrix)
+            self.assertEqual(tripintripout_matrix.calibrate([1.0, 2.0, 3.0, 4.0]),
+                             loaded_matrix.calibrate([1.0, 2.0, 3.0, 4.0]))
+            with open(path, "r+b") as f:
+                f.write(b"XXXX")
+            with self.assertRaises(ValueError):
+                TripInTripOutMatrix.load(path)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_load_with_mmap(self):
+        dim = 5
+        tripintripout_matrix = TripInTripOutMatrix(dim)
+        for ind, (i, j) in enumerate(iter_packed_keys(dim)):
+            tripintripout_matrix[i, j] = ind / 3.0
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "matrix.bin")
+            tripintripout_matrix.save(path)
+            loaded_matrix = TripInTripOutMatrix.load(path, use_mmap=True)
+            self.assertTrue(isinstance(loaded_matrix._values, ctypes.Array))
+            self.assertEqual(list(tripintripout_matrix._values), list(loaded_matrix._values))
+            self.assertEqual(tripintripout_matrix.get_section_volumes(), loaded_matrix.get_section_volumes())
+            self.assertEqual(tripintripout_matrix.calibrate([1.0, 2.0, 3.0, 4.0]),
+                             loaded_matrix.calibrate([1.0, 2.0, 3.0, 4.0]))
+            self.assertEqual(calibrate_packed(tripintripout_matrix._values, [1.0, 2.0, 3.0, 4.0]),
+                             calibrate_packed(loaded_matrix._values, [1.0, 2.0, 3.0, 4.0]))
+            # the mapping is copy-on-write, changes are not written to the file
+            loaded_matrix[1, 2] = 100.0
+            self.assertEqual(tripintripout_matrix, TripInTripOutMatrix.load(path, use_mmap=True))
+            del loaded_matrix
+
+            with open(path, "ab") as f:
+                f.write(b"X")
+            for use_mmap in [False, True]:
+                with self.assertRaises(ValueError):
+                    TripInTripOutMatrix.load(path, use_mmap=use_mmap)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_write_csv_and_repr(self):
+        tripintripout_matrix = TripInTripOutMatrix(3)
+        tripintripout_matrix[1, 2] = 1.5
+        tripintripout_matrix[2, 3] = 2.0
+        f = StringIO()
+        tripintripout_matrix.write_csv(f)
+        self.assertEqual("i;j;value\n1;2;1.5\n2;3;2.0\n", f.getvalue())
+        self.assertEqual("    0.0000     1.5000     0.0000\n" +
+                         " " * 10 + "     0.0000     2.0000\n" +
+                         " " * 10 + " " + " " * 10 + "     0.0000\n", repr(tripintripout_matrix))
+
+    def test_main(self):
+        directory = tempfile.mkdtemp()
+        try:
+            seed_1 = TripInTripOutMatrix(3)
+            seed_1[1, 2] = 1.0
+            seed_1[1, 3] = 2.0
+            seed_1[2, 3] = 3.0
+            seed_1.save(os.path.join(directory, "seed_1.tito"))
+            seed_2 = TripInTripOutMatrix(4)
+            for ind, (i, j) in enumerate(iter_packed_keys(4)):
+                seed_2[i, j] = ind + 1.0
+            seed_2.save(os.path.join(directory, "seed_2.tito"))
+            jobs = [("a", "seed_1.tito", seed_1, [4.0, 6.0]), ("b", "seed_2.tito", seed_2, [10.3, 25.5, 18.3]),
+                    ("c", "seed_1.tito", seed_1, [1.0, 2.5]), ("d", "seed_1.tito", seed_1, [7.0, 3.0])]
+            with open(os.path.join(directory, "jobs.csv"), "w") as f:
+                f.write("id;seed;volumes\n")
+                for job_id, seed_path, _, calibration_volumes in jobs:
+                    f.write(";".join([job_id, seed_path] + [str(volume) for volume in calibration_volumes]) + "\n")
+
+            for processes, output_format in [("1", "binary"), ("2", "csv")]:
+                output_dir = os.path.join(directory, "out_" + output_format)
+                self.assertEqual(0, main([os.path.join(directory, "jobs.csv"), output_dir, "--format", output_format,
+                                          "--processes", processes, "--chunk-size", "2"]))
+                for job_id, _, seed, calibration_volumes in jobs:
+                    should_be = seed.calibrate(calibration_volumes)
+                    if output_format == "binary":
+                        to_test = TripInTripOutMatrix.load(os.path.join(output_dir, job_id + ".tito"))
+                        self.assertEqual(should_be, to_test)
+                    else:
+                        to_test = StringIO()
+                        should_be.write_csv(to_test)
+                        with open(os.path.join(output_dir, job_id + ".csv")) as f:
+                            self.assertEqual(to_test.getvalue(), f.read())
+        finally:
+            shutil.rmtree(directory)
+
+    def test_calibrate_parallel(self):
+        jobs = []
+        for dim in [3, 5, 4, 5, 3]:
+            tripintripout_matrix = TripInTripOutMatrix(dim)
+            for ind, (i, j) in enumerate(iter_packed_keys(dim)):
+                tripintripout_matrix[i, j] = ind % 4 + 1.0
+            jobs += [(tripintripout_matrix, [float(dim + k) for k in range(dim - 1)])]
+        for processes in [1, 2]:
+            calibrated_matrices = calibrate_parallel(jobs, processes=processes, chunk_size=1)
+            self.assertEqual(len(jobs), len(calibrated_matrices))
+            for (tripintripout_matrix, volumes), calibrated_matrix in zip(jobs, calibrated_matrices):
+                self.assertEqual(tripintripout_matrix.calibrate(volumes), calibrated_matrix)
+
 
 if __name__ == "__main_":
     unittest.main()
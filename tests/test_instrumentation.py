@@ -0,0 +1,77 @@
+import json
+import os
+import unittest
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from scripts import instrumentation, route_aggregation, route_linearization
+from scripts.instrumentation import Instrumentation, write_rows
+from tests.directory_test_case import DirectoryTestCase
+from tests.test_visum_att import CSV_CONTENT, VISUM_ATT_CONTENT
+
+
+class InstrumentationTest(DirectoryTestCase):
+    def tearDown(self):
+        instrumentation.enable(False)
+        super(InstrumentationTest, self).tearDown()
+
+    def test_timer_and_count(self):
+        disabled = Instrumentation()
+        with disabled.timer("parse"):
+            disabled.count("stops", 3)
+        self.assertEqual([], disabled.get_report()["stages"])
+        self.assertEqual({}, disabled.get_report()["counts"])
+
+        enabled = Instrumentation(enabled=True)
+        for _ in range(2):
+            with enabled.timer("parse"):
+                enabled.count("stops", 3)
+        with self.assertRaises(ValueError):
+            with enabled.timer("sort"):
+                raise ValueError()
+        report = enabled.get_report()
+        self.assertEqual(["parse", "sort"], [stage["name"] for stage in report["stages"]])
+        self.assertEqual(2, report["stages"][0]["calls"])
+        self.assertGreater(report["stages"][0]["peak_rss_kb"], 0)
+        self.assertEqual({"stops": 6}, report["counts"])
+
+    def test_write_rows(self):
+        f = StringIO()
+        self.assertEqual(3, write_rows(f, [(1, "a"), (2, "b"), (3, "c")], chunk_size=2))
+        self.assertEqual("1;a\n2;b\n3;c\n", f.getvalue())
+
+        f = StringIO()
+        self.assertEqual(2, write_rows(f, [(1, "Bahnhof; Nord"), (2, 'Platz "Mitte"')]))
+        self.assertEqual('1;"Bahnhof; Nord"\n2;"Platz ""Mitte"""\n', f.getvalue())
+
+    def test_route_aggregation_main(self):
+        path_in = self.write_file("tpi.att", VISUM_ATT_CONTENT)
+        path_out = os.path.join(self.directory, "groups.csv")
+        path_profile = os.path.join(self.directory, "profile.json")
+        self.assertEqual(0, route_aggregation.main([path_in, "--output", path_out, "--nb-subsequent-stops", "2",
+                                                    "--profile", path_profile]))
+        with open(path_out) as f:
+            self.assertEqual(["0;1", "0;2"], sorted(f.read().splitlines()))
+        with open(path_profile) as f:
+            report = json.load(f)
+        self.assertEqual(["parse", "index build", "merge", "write"], [stage["name"] for stage in report["stages"]])
+        self.assertEqual({"timeprofiles": 2, "timeprofileitems": 5, "timeprofile-groups": 1}, report["counts"])
+
+    def test_route_linearization_main(self):
+        path_in = self.write_file("routes.csv", CSV_CONTENT)
+        path_out = os.path.join(self.directory, "sorted.csv")
+        path_profile = os.path.join(self.directory, "profile.json")
+        self.assertEqual(0, route_linearization.main([path_in, path_out, "--profile", path_profile]))
+        with open(path_out) as f:
+            self.assertEqual("index_sorted;stop\n1;A\n2;B\n3;C\n", f.read())
+        with open(path_profile) as f:
+            report = json.load(f)
+        self.assertEqual(["parse", "sort", "write"], [stage["name"] for stage in report["stages"]])
+        self.assertEqual({"stops": 3, "edges": 2}, report["counts"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import os
+import time
+import unittest
+
+from scripts import route_linearization
+from scripts.result_cache import ResultCache, get_fingerprint
+from scripts.route_aggregation import aggregate_routes
+from scripts.stop_graph import StopGraph
+from tests.directory_test_case import DirectoryTestCase
+from tests.test_route_aggregation import ROUTE_PER_ID
+from tests.test_visum_att import CSV_CONTENT
+
+
+class ResultCacheTest(DirectoryTestCase):
+    def test_get_fingerprint(self):
+        route_per_id = dict(ROUTE_PER_ID)
+        reversed_route_per_id = dict(reversed(list(ROUTE_PER_ID.items())))
+        self.assertEqual(get_fingerprint(route_per_id, 3), get_fingerprint(reversed_route_per_id, 3))
+        self.assertNotEqual(get_fingerprint(route_per_id, 3), get_fingerprint(route_per_id, 4))
+        self.assertNotEqual(get_fingerprint({1: (1, 2)}), get_fingerprint({1: [1, 2]}))
+        self.assertNotEqual(get_fingerprint(["1"]), get_fingerprint([1]))
+        graph = StopGraph.from_routes([(1, 2, 3), (2, 4)])
+        self.assertEqual(get_fingerprint(graph), get_fingerprint(StopGraph.from_routes([(1, 2, 3), (2, 4)])))
+        self.assertNotEqual(get_fingerprint(graph), get_fingerprint(StopGraph.from_routes([(1, 2, 3), (4, 2)])))
+        # a StopGraph is fingerprinted by its stops and compressed rows only
+        fingerprint = get_fingerprint(graph)
+        graph.id_per_stop = None
+        self.assertEqual(fingerprint, get_fingerprint(graph))
+        self.assertNotEqual(get_fingerprint([1, 2]), get_fingerprint([[1, 2]]))
+        self.assertNotEqual(get_fingerprint({1: 2, 3: 4}), get_fingerprint({1: 4, 3: 2}))
+
+    def test_call(self):
+        result_cache = ResultCache(os.path.join(self.directory, "cache"))
+        should_be = aggregate_routes(ROUTE_PER_ID, nb_subsequent_stops=2)
+        self.assertEqual(should_be, result_cache.call(aggregate_routes, ROUTE_PER_ID, nb_subsequent_stops=2))
+        self.assertEqual(should_be, result_cache.call(aggregate_routes, dict(ROUTE_PER_ID), nb_subsequent_stops=2))
+        self.assertEqual((1, 1), (result_cache.nb_hits, result_cache.nb_misses))
+        result_cache.call(aggregate_routes, ROUTE_PER_ID, nb_subsequent_stops=3)
+        self.assertEqual((1, 2), (result_cache.nb_hits, result_cache.nb_misses))
+
+        # another cache on the same directory finds the results
+        other_result_cache = ResultCache(os.path.join(self.directory, "cache"))
+        self.assertEqual(should_be, other_result_cache.call(aggregate_routes, ROUTE_PER_ID, nb_subsequent_stops=2))
+        self.assertEqual((1, 0), (other_result_cache.nb_hits, other_result_cache.nb_misses))
+
+    def test_call_of_changed_function(self):
+        result_cache = ResultCache(self.directory)
+
+        def get_result(value):
+            return value + 1
+        self.assertEqual(2, result_cache.call(get_result, 1))
+
+        def get_result(value):
+            return value + 2
+        # same module and name, but another bytecode
+        self.assertEqual(3, result_cache.call(get_result, 1))
+        self.assertEqual((0, 2), (result_cache.nb_hits, result_cache.nb_misses))
+        self.assertEqual(3, result_cache.call(get_result, 1))
+        self.assertEqual((1, 2), (result_cache.nb_hits, result_cache.nb_misses))
+
+    def test_entry_evicted_after_loading(self):
+        result_cache = ResultCache(self.directory)
+        result_cache.put("key", [1, 2])
+        utime = os.utime
+
+        def evict_and_utime(path, times):
+            os.remove(path)
+            utime(path, times)
+        os.utime = evict_and_utime
+        try:
+            self.assertEqual((True, [1, 2]), result_cache.get("key"))
+        finally:
+            os.utime = utime
+        self.assertEqual((False, None), result_cache.get("key"))
+
+    def test_corrupt_entry(self):
+        result_cache = ResultCache(self.directory)
+        result_cache.put("key", [1, 2])
+        with open(os.path.join(self.directory, "key.pickle"), "wb") as f:
+            f.write(b"no pickle")
+        self.assertEqual((False, None), result_cache.get("key"))
+        self.assertFalse(os.path.exists(os.path.join(self.directory, "key.pickle")))
+
+    def test_eviction(self):
+        result_cache = ResultCache(self.directory, max_size_bytes=3500)
+        for ind, key in enumerate(["a", "b", "c"]):
+            result_cache.put(key, "x" * 1000)
+            os.utime(os.path.join(self.directory, key + ".pickle"), (time.time() - 100 + ind, time.time() - 100 + ind))
+        self.assertEqual((True, "x" * 1000), result_cache.get("a"))
+        result_cache.put("d", "x" * 1000)
+        self.assertEqual(["a.pickle", "c.pickle", "d.pickle"], sorted(os.listdir(self.directory)))
+        with self.assertRaises(ValueError):
+            ResultCache(self.directory, max_size_bytes=0)
+
+    def test_route_linearization_main(self):
+        path_in = self.write_file("routes.csv", CSV_CONTENT)
+        path_out = os.path.join(self.directory, "sorted.csv")
+        cache_dir = os.path.join(self.directory, "cache")
+        for _ in range(2):
+            self.assertEqual(0, route_linearization.main([path_in, path_out, "--cache-dir", cache_dir]))
+            with open(path_out) as f:
+                self.assertEqual("index_sorted;stop\n1;A\n2;B\n3;C\n", f.read())
+        self.assertEqual(1, len(os.listdir(cache_dir)))
+
+
+if __name__ == '__main__':
+    unittest.main()
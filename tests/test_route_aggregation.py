@@ -1,7 +1,10 @@
+import itertools
+import random
 import unittest
 
-from scripts.route_aggregation import aggregate_routes, get_routes_per_subsequent_stop_tuples, \
-    get_subsequent_stop_tuples
+from scripts import route_aggregation
+from scripts.route_aggregation import RouteAggregator, StopSequenceIndex, UnionFind, aggregate_routes, \
+    aggregate_routes_fuzzy, aggregate_routes_multi, get_routes_per_subsequent_stop_tuples, get_subsequent_stop_tuples
 
 ROUTE_PER_ID = {
     1: (1, 2, 3),
@@ -47,6 +50,179 @@ class RouteAggregationTests(unittest.TestCase):
         self.assertTrue({7} in aggregated_routes)
         self.assertTrue({8} in aggregated_routes)
 
+    def test_aggregate_routes_multi(self):
+        route_per_id = dict(ROUTE_PER_ID)
+        route_per_id[9] = (1, 2, 1, 2, 3)
+        aggregated_routes_per_threshold = aggregate_routes_multi(route_per_id, [5, 1, 3, 4, 2, 7])
+        self.assertEquals([1, 2, 3, 4, 5, 7], sorted(aggregated_routes_per_threshold))
+        for threshold, aggregated_routes in aggregated_routes_per_threshold.items():
+            self.assertEquals(aggregate_routes(route_per_id, nb_subsequent_stops=threshold), aggregated_routes)
+
+    def test_aggregate_routes_fuzzy(self):
+        route_per_id = {
+            1: (1, 2, 3, 4, 5, 6, 7, 8),
+            2: (1, 2, 3, 4, 9, 5, 6, 7, 8),
+            3: (1, 2, 3, 5, 6, 7, 8),
+            4: (1, 2, 30, 31, 32, 33),
+            5: (1, 2, 30, 31, 32, 33),
+            6: (40,),
+        }
+        should_be = frozenset([frozenset([1, 2, 3]), frozenset([4, 5]), frozenset([6])])
+        for seed in range(5):
+            self.assertEquals(should_be, aggregate_routes_fuzzy(route_per_id, jaccard_threshold=0.6, nb_bands=32,
+                                                                seed=seed))
+        should_be = frozenset([frozenset([1]), frozenset([2]), frozenset([3]), frozenset([4, 5]), frozenset([6])])
+        self.assertEquals(should_be, aggregate_routes(route_per_id, nb_subsequent_stops=5))
+        self.assertEquals(should_be, aggregate_routes_fuzzy(route_per_id, jaccard_threshold=0.7, nb_bands=32))
+        with self.assertRaises(ValueError):
+            aggregate_routes_fuzzy(route_per_id, jaccard_threshold=0.0)
+        with self.assertRaises(ValueError):
+            aggregate_routes_fuzzy(route_per_id, nb_bands=5)
+
+    def test_aggregate_routes_fuzzy_shared_trunk(self):
+        # all routes share one bucket per band, which must not be compared pairwise
+        calls = {"jaccard": 0, "find": 0}
+        get_jaccard_index = route_aggregation._get_jaccard_index
+        find = UnionFind.find
+
+        def count_jaccard(set_1, set_2):
+            calls["jaccard"] += 1
+            return get_jaccard_index(set_1, set_2)
+
+        def count_find(union_find, element):
+            calls["find"] += 1
+            return find(union_find, element)
+
+        def get_calls(nb_routes):
+            route_per_id = dict((route_id, tuple(range(20)) + (100 + route_id,)) for route_id in range(nb_routes))
+            calls.update(jaccard=0, find=0)
+            aggregated_routes = aggregate_routes_fuzzy(route_per_id, jaccard_threshold=0.8)
+            self.assertEquals(frozenset([frozenset(route_per_id)]), aggregated_routes)
+            return dict(calls)
+
+        route_aggregation._get_jaccard_index = count_jaccard
+        UnionFind.find = count_find
+        try:
+            small_calls = get_calls(250)
+            large_calls = get_calls(1000)
+        finally:
+            route_aggregation._get_jaccard_index = get_jaccard_index
+            UnionFind.find = find
+        self.assertLess(large_calls["jaccard"], 1000)
+        # 4 times the routes take about 4 times the calls, while comparing all pairs takes about 16 times the calls
+        self.assertLess(large_calls["find"], 5 * small_calls["find"])
+
+    def test_aggregate_routes_fuzzy_recall(self):
+        def get_route_per_id(seed):
+            # variants of a few lines with skipped, inserted and cut stops
+            rnd = random.Random(seed)
+            lines = [rnd.sample(range(60), rnd.randint(6, 12)) for _ in range(4)]
+            route_per_id = {}
+            for route_id in range(30):
+                route_stops = list(rnd.choice(lines))
+                for _ in range(rnd.randint(0, 3)):
+                    change = rnd.random()
+                    if change < 0.4 and len(route_stops) > 3:
+                        del route_stops[rnd.randrange(len(route_stops))]
+                    elif change < 0.8:
+                        route_stops.insert(rnd.randrange(len(route_stops) + 1), rnd.randrange(60))
+                    else:
+                        route_stops = route_stops[1:] if rnd.random() < 0.5 else route_stops[:-1]
+                route_per_id[route_id] = tuple(route_stops)
+            return route_per_id
+
+        def get_exact_groups(route_per_id, jaccard_threshold):
+            sequences_per_id = dict((route_id, frozenset(get_subsequent_stop_tuples(route_stops, 2)))
+                                    for route_id, route_stops in route_per_id.items())
+            route_groups = UnionFind(route_per_id)
+            for route_id, other_route_id in itertools.combinations(route_per_id, 2):
+                if route_aggregation._get_jaccard_index(sequences_per_id[route_id],
+                                                        sequences_per_id[other_route_id]) >= jaccard_threshold:
+                    route_groups.union(route_id, other_route_id)
+            return route_groups.get_groups()
+
+        nb_exact = 0
+        for seed in range(50):
+            route_per_id = get_route_per_id(seed)
+            exact_groups = get_exact_groups(route_per_id, 0.6)
+            for nb_bands in [None, 64]:
+                aggregated_routes = aggregate_routes_fuzzy(route_per_id, jaccard_threshold=0.6, nb_bands=nb_bands)
+                # no pair is merged wrongly
+                self.assertTrue(all(any(group <= exact_group for exact_group in exact_groups)
+                                    for group in aggregated_routes))
+            nb_exact += aggregated_routes == exact_groups
+        # with one row per band, only the comparison with one route per group misses pairs
+        self.assertGreaterEqual(nb_exact, 45)
+
+    def test_route_aggregator(self):
+        route_aggregator = RouteAggregator(ROUTE_PER_ID)
+        self.assertEquals(aggregate_routes(ROUTE_PER_ID), route_aggregator.get_groups())
+
+        route_aggregator.remove_route(3)
+        self.assertTrue({1, 2, 4} in route_aggregator.get_groups())
+        self.assertTrue({5} in route_aggregator.get_groups())
+
+        route_aggregator.update_route(8, (11, 12, 13, 14))
+        route_aggregator.add_route(9, (3, 4, 5, 6))
+        route_per_id = dict(ROUTE_PER_ID)
+        del route_per_id[3]
+        route_per_id[8] = (11, 12, 13, 14)
+        route_per_id[9] = (3, 4, 5, 6)
+        self.assertEquals(aggregate_routes(route_per_id), route_aggregator.get_groups())
+        self.assertEquals({5}, StopSequenceIndex(route_per_id).get_neighbour_routes(9))
+
+    def test_union_find(self):
+        union_find = UnionFind(range(6))
+        union_find.union(0, 1)
+        union_find.union(2, 3)
+        union_find.union(1, 3)
+        union_find.add(6)
+        self.assertEquals(union_find.find(0), union_find.find(2))
+        self.assertNotEquals(union_find.find(0), union_find.find(4))
+        self.assertEquals(frozenset([frozenset([0, 1, 2, 3]), frozenset([4]), frozenset([5]), frozenset([6])]),
+                          union_find.get_groups())
+
+    def test_stop_sequence_index(self):
+        stop_sequence_index = StopSequenceIndex(ROUTE_PER_ID, 3)
+        self.assertEquals(len(get_routes_per_subsequent_stop_tuples(ROUTE_PER_ID, 3)), len(stop_sequence_index))
+        self.assertEquals({1, 2, 3, 4}, stop_sequence_index.get_routes((1, 2, 3)))
+        self.assertEquals({3, 4}, stop_sequence_index.get_routes((2, 3, 4)))
+        self.assertEquals(set(), stop_sequence_index.get_routes((1, 2, 4)))
+        self.assertEquals(set(), stop_sequence_index.get_routes((1, 2, 99)))
+        self.assertRaises(ValueError, stop_sequence_index.get_routes, (1, 2))
+
+    def test_stop_sequence_index_reuses_removed_routes(self):
+        stop_sequence_index = StopSequenceIndex(ROUTE_PER_ID, 3)
+        for ind in range(100):
+            stop_sequence_index.remove_route(3)
+            stop_sequence_index.add_route(3, (1, 2, 3, 4, 5, 6) if ind % 2 else (4, 5, 6, 1, 2, 3))
+            stop_sequence_index.remove_route(5)
+            stop_sequence_index.add_route(5, (4, 5, 6, 8))
+        self.assertEquals(len(ROUTE_PER_ID), len(stop_sequence_index._route_ids))
+        self.assertEquals(len(ROUTE_PER_ID), len(stop_sequence_index._stop_ids_per_route))
+        self.assertEquals({1, 2, 3, 4}, stop_sequence_index.get_routes((1, 2, 3)))
+        self.assertEquals({3, 5}, stop_sequence_index.get_routes((4, 5, 6)))
+        self.assertEquals(aggregate_routes(ROUTE_PER_ID), RouteAggregator(ROUTE_PER_ID).get_groups())
+
+    def test_stop_sequence_index_many_stops(self):
+        stop_sequence_index = StopSequenceIndex(nb_subsequent_stops=2)
+        for route_id in range(1000):
+            stop_sequence_index.add_route(route_id, tuple(range(100 * route_id, 100 * route_id + 100)))
+        stop_sequence_index.add_route("a", (99998, 99999))
+        self.assertEquals({999, "a"}, stop_sequence_index.get_routes((99998, 99999)))
+        self.assertEquals({0}, stop_sequence_index.get_routes((0, 1)))
+
+    def test_stop_sequence_index_keys_stay_small(self):
+        # 70000 stops need 17 bits per stop, so the keys of 3 stops fit into 51 bits
+        route_per_id = dict((route_id, tuple(range(100 * route_id, 100 * route_id + 100))) for route_id in range(700))
+        stop_sequence_index = StopSequenceIndex(route_per_id, nb_subsequent_stops=3)
+        self.assertLess(max(stop_sequence_index._route_indices_per_key), 1 << 51)
+        self.assertEquals({699}, stop_sequence_index.get_routes((69997, 69998, 69999)))
+        stop_sequence_index.add_route("a", (69998, 69999, 70000, 0))
+        self.assertEquals({"a"}, stop_sequence_index.get_routes((69998, 69999, 70000)))
+        self.assertEquals({699}, stop_sequence_index.get_routes((69997, 69998, 69999)))
+        self.assertLess(max(stop_sequence_index._route_indices_per_key), 1 << 51)
+
     def test_get_routes_per_subsequent_stop_tuples(self):
         routes_per_subsequent_stop_tuples = get_routes_per_subsequent_stop_tuples(ROUTE_PER_ID, 3)
         self.assertEquals({1, 2, 3, 4}, routes_per_subsequent_stop_tuples[(1, 2, 3)])
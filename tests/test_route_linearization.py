@@ -1,9 +1,13 @@
 import unittest
 
-from scripts.route_linearization import linearize_stops_in_multiple_routes
+from scripts.route_linearization import CycleError, get_linear_order_cost, get_strongly_connected_components, \
+    get_successors_per_stop_from_file, get_weakly_connected_components, improve_linear_order, linearize_network, \
+    linearize_stops_in_multiple_routes, remove_feedback_edges
+from scripts.stop_graph import StopGraph
+from tests.directory_test_case import DirectoryTestCase
 
 
-class RouteAggregationTest(unittest.TestCase):
+class RouteAggregationTest(DirectoryTestCase):
 
     def test_linearize_multiple_routes_trivial_graph(self):
         sort_index_per_stop = linearize_stops_in_multiple_routes({1: set()})
@@ -38,6 +42,85 @@ class RouteAggregationTest(unittest.TestCase):
         self.assertTrue(sort_index_per_stop[9] == (sort_index_per_stop[7] + 1))
         self.assertTrue(sort_index_per_stop[10] == (sort_index_per_stop[9] + 1))
 
+    def test_linearize_multiple_routes_long_route(self):
+        nb_stops = 20000
+        successors_per_stop = {s: {s + 1} for s in range(1, nb_stops)}
+        successors_per_stop[nb_stops] = set()
+        sort_index_per_stop = linearize_stops_in_multiple_routes(successors_per_stop)
+        self.assertEquals({s: s for s in range(1, nb_stops + 1)}, sort_index_per_stop)
+
+    def test_linearize_multiple_routes_cycle(self):
+        with self.assertRaises(CycleError) as context:
+            linearize_stops_in_multiple_routes({1: {2}, 2: {3}, 3: {4}, 4: {2, 5}, 5: set()})
+        self.assertEquals([2, 3, 4], context.exception.stops)
+
+    def test_get_successors_per_stop_from_file_with_interleaved_routes(self):
+        path = self.write_file("routes.csv", "Id;Richtung;Name\n1;R;A\n1;R;B\n2;H;X\n2;H;Y\n1;R;C\n1;R;D\n")
+        successors_per_stop = get_successors_per_stop_from_file(path)
+        self.assertEquals({"D": {"C"}, "C": {"B"}, "B": {"A"}, "A": set(), "X": {"Y"}, "Y": set()},
+                          dict(successors_per_stop))
+
+    def test_strongly_connected_components(self):
+        components = get_strongly_connected_components({1: {2}, 2: {3}, 3: {1, 4}, 4: {5}, 5: {4}, 6: {6}})
+        self.assertEquals({frozenset([1, 2, 3]), frozenset([4, 5]), frozenset([6])},
+                          {frozenset(component) for component in components})
+
+    def test_remove_feedback_edges(self):
+        acyclic_successors_per_stop, removed_edges = remove_feedback_edges(
+            {1: {2}, 2: {3}, 3: {1, 4}, 4: {5}, 5: {4}, 6: {6}})
+        self.assertEquals(3, len(removed_edges))
+        self.assertTrue((6, 6) in removed_edges)
+        linearize_stops_in_multiple_routes(acyclic_successors_per_stop)
+
+    def test_linearize_network(self):
+        successors_per_stop = {1: {2}, 2: {3}, 3: {1, 4}, 4: set(), "a": {"b"}, "b": {"a", "c"}, "c": set(), 9: set()}
+        for processes in [1, 2]:
+            sort_index_per_stop, component_per_stop = linearize_network(successors_per_stop, processes=processes)
+            self.assertEquals({1: 1, 2: 1, 3: 1, 4: 1, 9: 2, "a": 3, "b": 3, "c": 3}, component_per_stop)
+            self.assertEquals([1, 2, 3, 4], sorted(sort_index_per_stop[s] for s in [1, 2, 3, 4]))
+            self.assertEquals(1, sort_index_per_stop[9])
+            self.assertEquals([1, 2, 3], sorted(sort_index_per_stop[s] for s in ["a", "b", "c"]))
+            self.assertTrue(sort_index_per_stop[4] > sort_index_per_stop[3])
+            self.assertTrue(sort_index_per_stop["c"] > sort_index_per_stop["b"])
+
+    def test_stop_graph_input(self):
+        successors_per_stop = {1: {2}, 2: {3}, 3: {1, 4}, 4: set(), "a": {"b"}, "b": {"a", "c"}, "c": set(), 9: {9}}
+        stop_graph = StopGraph.from_successors_per_stop(successors_per_stop)
+        self.assertEquals(get_weakly_connected_components(successors_per_stop),
+                          get_weakly_connected_components(stop_graph))
+        self.assertEquals(get_strongly_connected_components(successors_per_stop),
+                          get_strongly_connected_components(stop_graph))
+        acyclic_successors_per_stop, removed_edges = remove_feedback_edges(successors_per_stop)
+        acyclic_stop_graph, removed_edges_of_graph = remove_feedback_edges(stop_graph)
+        self.assertTrue(isinstance(acyclic_stop_graph, StopGraph))
+        self.assertEquals(acyclic_successors_per_stop, acyclic_stop_graph.to_successors_per_stop())
+        self.assertEquals(removed_edges, removed_edges_of_graph)
+        self.assertEquals(linearize_network(successors_per_stop), linearize_network(stop_graph, processes=2))
+        sort_index_per_stop = linearize_stops_in_multiple_routes(acyclic_stop_graph)
+        self.assertEquals(improve_linear_order(acyclic_successors_per_stop, sort_index_per_stop),
+                          improve_linear_order(acyclic_stop_graph, sort_index_per_stop))
+        self.assertEquals(get_linear_order_cost(acyclic_successors_per_stop, sort_index_per_stop),
+                          get_linear_order_cost(acyclic_stop_graph, sort_index_per_stop))
+
+    def test_improve_linear_order(self):
+        successors_per_stop = {1: {2, 5}, 2: {3}, 3: {4}, 4: set(), 5: set(), 6: {7}, 7: {2}}
+        sort_index_per_stop = {1: 1, 2: 2, 3: 3, 4: 4, 5: 5, 6: 6, 7: 7}
+        self.assertEquals(4 + 4 + 5 * 10, get_linear_order_cost(successors_per_stop, sort_index_per_stop))
+        improved_sort_index_per_stop = improve_linear_order(successors_per_stop, sort_index_per_stop)
+        self.assertEquals(sorted(sort_index_per_stop.values()), sorted(improved_sort_index_per_stop.values()))
+        self.assertTrue(get_linear_order_cost(successors_per_stop, improved_sort_index_per_stop) <
+                        get_linear_order_cost(successors_per_stop, sort_index_per_stop))
+
+    def test_improve_linear_order_keeps_topological_order(self):
+        successors_per_stop = {1: {2, 3}, 2: {4}, 3: {5}, 4: {6}, 5: {6}, 6: set(), 7: {3}}
+        sort_index_per_stop = linearize_stops_in_multiple_routes(successors_per_stop)
+        improved_sort_index_per_stop = improve_linear_order(successors_per_stop, sort_index_per_stop)
+        for stop, sucs in successors_per_stop.items():
+            for suc in sucs:
+                self.assertTrue(improved_sort_index_per_stop[suc] > improved_sort_index_per_stop[stop])
+        self.assertTrue(get_linear_order_cost(successors_per_stop, improved_sort_index_per_stop) <=
+                        get_linear_order_cost(successors_per_stop, sort_index_per_stop))
+
 
 if __name__ == '__main__':
     unittest.main()
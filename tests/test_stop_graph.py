@@ -0,0 +1,24 @@
+import unittest
+
+from scripts.stop_graph import StopGraph
+
+
+class StopGraphTest(unittest.TestCase):
+    def test_from_routes(self):
+        stop_graph = StopGraph.from_routes([("a", "b", "c"), ("d", "b", "c"), ("a", "b")])
+        self.assertEqual(["a", "b", "c", "d"], stop_graph.stops)
+        self.assertEqual(4, stop_graph.get_nb_stops())
+        self.assertEqual(3, stop_graph.get_nb_edges())
+        self.assertEqual([1], list(stop_graph.get_successor_ids(0)))
+        self.assertEqual([0, 3], list(stop_graph.get_predecessor_ids(1)))
+        self.assertEqual([], list(stop_graph.get_predecessor_ids(3)))
+
+    def test_to_successors_per_stop(self):
+        successors_per_stop = {1: {2, 3}, 2: {3}, 3: set(), 4: {3}}
+        stop_graph = StopGraph.from_successors_per_stop(successors_per_stop)
+        self.assertEqual(successors_per_stop, stop_graph.to_successors_per_stop())
+        self.assertEqual([0, 1, 3], list(stop_graph.get_predecessor_ids(stop_graph.id_per_stop[3])))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import unittest
+
+from scripts.route_aggregation import get_routes_from_visum_att_file
+from scripts.visum_att import iter_routes, iter_rows
+from tests.directory_test_case import DirectoryTestCase
+
+VISUM_ATT_CONTENT = """$VISION
+* Test
+$VERSION:VERSNR;FILETYPE;LANGUAGE;UNIT
+12.00;Att;ENG;KM
+
+*
+* Table: Time profile items
+*
+$TIMEPROFILEITEM:TIMEPROFILEID;INDEX;LINEROUTEITEM\\STOPPOINT\\STOPAREA\\STOP\\NO
+1;1;10
+1;2;11
+1;3;12
+2;1;11
+2;2;12
+
+$TIMEPROFILE:ID;NAME
+1;a
+"""
+
+CSV_CONTENT = """Id;Richtung;Name
+1;H;A
+1;H;B
+1;R;C
+1;R;B
+"""
+
+
+class VisumAttTest(DirectoryTestCase):
+    def test_iter_rows_visum(self):
+        path = self.write_file("tpi.att", VISUM_ATT_CONTENT)
+        rows = list(iter_rows(path, [r"LINEROUTEITEM\STOPPOINT\STOPAREA\STOP\NO", "TIMEPROFILEID"]))
+        self.assertEqual([("10", "1"), ("11", "1"), ("12", "1"), ("11", "2"), ("12", "2")], rows)
+
+    def test_iter_routes_csv(self):
+        path = self.write_file("routes.csv", CSV_CONTENT)
+        routes = list(iter_routes(path, ["Id", "Richtung"], "Name"))
+        self.assertEqual([(("1", "H"), ("A", "B")), (("1", "R"), ("C", "B"))], routes)
+
+    def test_missing_column(self):
+        path = self.write_file("routes.csv", CSV_CONTENT)
+        with self.assertRaises(ValueError):
+            list(iter_rows(path, ["Id", "Direction"]))
+
+    def test_get_routes_from_gzip_visum_att_file(self):
+        path = self.write_file("tpi.att.gz", VISUM_ATT_CONTENT, compress=True)
+        self.assertEqual({1: (10, 11, 12), 2: (11, 12)}, get_routes_from_visum_att_file(path))
+
+
+if __name__ == '__main__':
+    unittest.main()